@@ -1,10 +1,17 @@
 """
 Flask приложение для Cloud Run
 """
-from flask import Flask, jsonify
+from flask import Flask, jsonify, request, Response, stream_with_context
+from datetime import datetime
 import asyncio
+import contextlib
+import hmac
 import os
 import logging
+import export
+import metrics
+import profiling
+from token_budget import TokenBudget
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -61,7 +68,13 @@ def init_components():
         
         try:
             if Config.OPENAI_API_KEY:
-                parser = DeliveryParser(Config.OPENAI_API_KEY)
+                parser = DeliveryParser(
+                    Config.OPENAI_API_KEY,
+                    model=Config.LLM_MODEL,
+                    cheap_model=Config.LLM_CHEAP_MODEL,
+                    short_email_tokens=Config.LLM_SHORT_EMAIL_TOKENS,
+                    max_tokens=Config.LLM_MAX_TOKENS
+                )
                 logger.info("✅ Парсер инициализирован")
         except Exception as e:
             logger.warning(f"⚠️ Ошибка инициализации парсера: {e}")
@@ -89,39 +102,119 @@ def health_check():
     return jsonify({'status': 'ok', 'message': 'Delivery Bot is running'}), 200
 
 
+def is_admin() -> bool:
+    """Запрос подписан админским токеном (заголовок X-Admin-Token)"""
+    from config import Config
+    
+    token = request.headers.get('X-Admin-Token', '')
+    return bool(Config.ADMIN_TOKEN) and hmac.compare_digest(token, Config.ADMIN_TOKEN)
+
+
+BOOL_ARGS = {'true': True, '1': True, 'false': False, '0': False}
+
+
+def bool_arg(name: str):
+    """Булев параметр запроса: true/false/1/0, None если не задан (ValueError на остальное)"""
+    value = request.args.get(name)
+    if value is None:
+        return None
+    if value.lower() not in BOOL_ARGS:
+        raise ValueError(f'{name} must be true, false, 1 or 0')
+    return BOOL_ARGS[value.lower()]
+
+
 @app.route('/check', methods=['POST'])
 def check_deliveries():
-    """Ручная проверка доставок"""
+    """Ручная проверка доставок (?profile=1 - с профилированием, только для админа)"""
     try:
         if not all([db, gmail_client, parser, telegram_bot]):
             return jsonify({'status': 'error', 'message': 'Components not initialized'}), 500
         
-        logger.info("🔍 Проверяю доставки...")
+        from config import Config
         
-        # Получаем письма
-        emails = gmail_client.get_emails_since(hours=24)
-        if not emails:
-            logger.info("📭 Писем не найдено")
-            return jsonify({'status': 'ok', 'message': 'No emails found', 'count': 0}), 200
+        requested = request.args.get('profile') in ('1', 'true')
+        if requested and not is_admin():
+            return jsonify({'status': 'error', 'message': 'Forbidden'}), 403
         
-        # Парсим письма
-        deliveries = parser.batch_parse_emails(emails)
-        logger.info(f"✅ Найдено {len(deliveries)} доставок")
+        mode = profiling.choose_mode(requested, Config.PROFILE_SAMPLE_RATE)
+        session = profiling.ProfileSession(mode) if mode else contextlib.nullcontext()
+        with session:
+            payload = run_check()
         
-        # Сохраняем и отправляем
-        count = 0
-        for delivery in deliveries:
-            db.add_delivery(delivery)
-            message = parser.format_for_telegram(delivery)
-            asyncio.run(telegram_bot.send_message(Config.TELEGRAM_CHAT_ID, message))
-            count += 1
+        if mode and session.active:
+            path = None
+            try:
+                path = session.save(Config.PROFILE_DIR, keep=Config.PROFILE_KEEP)
+            except OSError as e:
+                logger.error(f"❌ Не удалось сохранить профиль: {e}")
+            if requested:
+                payload['profile'] = session.report
+                payload['profile_path'] = path
         
-        return jsonify({'status': 'ok', 'message': f'Processed {count} deliveries', 'count': count}), 200
+        return jsonify(payload), 200
     except Exception as e:
         logger.error(f"❌ Ошибка: {e}")
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
 
+def run_check() -> dict:
+    """Получить письма, распарсить, сохранить и отправить в Telegram"""
+    from config import Config
+    
+    logger.info("🔍 Проверяю доставки...")
+    
+    # Завершаем зависшие и архивируем старые доставки
+    db.run_retention(Config.RETENTION_STALE_DAYS, Config.RETENTION_ARCHIVE_DAYS, Config.RETENTION_BATCH_SIZE)
+    
+    # Получаем письма
+    emails = gmail_client.get_emails_since(hours=24)
+    deferred_ids = db.get_deferred_email_ids()
+    # Отложенные письма ждут дольше остальных - парсим их первыми
+    emails = gmail_client.merge_deferred(emails, deferred_ids)
+    if not emails:
+        logger.info("📭 Писем не найдено")
+        return {'status': 'ok', 'message': 'No emails found', 'count': 0}
+    
+    # Парсим письма в пределах бюджета токенов
+    budget = TokenBudget(Config.LLM_RUN_TOKEN_BUDGET, Config.LLM_DAILY_TOKEN_BUDGET, db.get_tokens_used_today())
+    deliveries = parser.batch_parse_emails(emails, budget)
+    db.save_llm_usage(budget.summary())
+    if deferred_ids or parser.deferred:
+        db.set_deferred_email_ids(
+            [email['id'] for email in parser.deferred if email.get('id')],
+            max_age_days=Config.LLM_DEFERRED_MAX_DAYS,
+        )
+    logger.info(f"✅ Найдено {len(deliveries)} доставок")
+    
+    # Сохраняем события одной пачкой и отправляем
+    for delivery in deliveries:
+        db.record_event(delivery)
+    if db.flush_events() is None:
+        raise RuntimeError('Failed to save deliveries, notifications not sent')
+    # Заказы, которые не удалось сохранить, не уведомляем
+    deliveries = [d for d in deliveries if str(d.get('order_number')) not in db.failed_orders]
+    
+    count = 0
+    for delivery in deliveries:
+        message = parser.format_for_telegram(delivery)
+        asyncio.run(telegram_bot.send_message(Config.TELEGRAM_CHAT_ID, message))
+        count += 1
+    
+    return {
+        'status': 'ok',
+        'message': f'Processed {count} deliveries',
+        'count': count,
+        'deferred': len(parser.deferred),
+        'tokens': budget.used
+    }
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Метрики в формате Prometheus"""
+    return Response(metrics.REGISTRY.render(), content_type=metrics.CONTENT_TYPE)
+
+
 @app.route('/status', methods=['GET'])
 def get_status():
     """Получить статус доставок"""
@@ -136,6 +229,104 @@ def get_status():
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
 
+@app.route('/find', methods=['GET'])
+def find_deliveries():
+    """Полнотекстовый поиск доставок (?q=текст&limit=20, только для админа)"""
+    try:
+        if not db:
+            return jsonify({'status': 'error'}), 500
+        if not is_admin():
+            return jsonify({'status': 'error', 'message': 'Forbidden'}), 403
+        
+        query = request.args.get('q', '').strip()
+        if not query:
+            return jsonify({'status': 'error', 'message': 'Query parameter q is required'}), 400
+        
+        limit = max(1, min(request.args.get('limit', 20, type=int), 100))
+        results = [row._asdict() for row in db.search_deliveries(query, limit=limit)]
+        return jsonify({'status': 'ok', 'count': len(results), 'data': results}), 200
+    except Exception as e:
+        logger.error(f"❌ Ошибка: {e}")
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+
+@app.route('/history/<order_number>', methods=['GET'])
+def delivery_history(order_number):
+    """История статусов доставки из журнала событий (только для админа)"""
+    try:
+        if not db:
+            return jsonify({'status': 'error'}), 500
+        if not is_admin():
+            return jsonify({'status': 'error', 'message': 'Forbidden'}), 403
+        
+        events = db.get_delivery_history(order_number)
+        if not events:
+            return jsonify({'status': 'error', 'message': 'Delivery not found'}), 404
+        
+        data = [{
+            'occurred_at': event.occurred_at.isoformat(),
+            'status': event.status,
+            'address': event.address,
+            'pickup_code': event.pickup_code,
+            'estimated_delivery': event.estimated_delivery,
+            'message_id': event.message_id
+        } for event in events]
+        return jsonify({'status': 'ok', 'order_number': order_number, 'data': data}), 200
+    except Exception as e:
+        logger.error(f"❌ Ошибка: {e}")
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+
+@app.route('/export', methods=['GET'])
+def export_deliveries():
+    """
+    Потоковая выгрузка доставок.
+    
+    ?format=ndjson|csv&service=СДЭК&active=true|false&since=2025-01-01&until=2025-02-01&archived=1
+    (since/until - по дате создания, ISO 8601; archived - вместе с deliveries_archive; только для админа)
+    """
+    try:
+        if not db:
+            return jsonify({'status': 'error'}), 500
+        if not is_admin():
+            return jsonify({'status': 'error', 'message': 'Forbidden'}), 403
+        
+        fmt = request.args.get('format', 'ndjson')
+        if fmt not in export.FORMATS:
+            return jsonify({'status': 'error', 'message': f'Unknown format {fmt}'}), 400
+        
+        try:
+            active = bool_arg('active')
+            archived = bool_arg('archived')
+        except ValueError as e:
+            return jsonify({'status': 'error', 'message': str(e)}), 400
+        try:
+            since = datetime.fromisoformat(request.args['since']) if request.args.get('since') else None
+            until = datetime.fromisoformat(request.args['until']) if request.args.get('until') else None
+        except ValueError as e:
+            return jsonify({'status': 'error', 'message': f'Invalid date: {e}'}), 400
+        
+        from database import EXPORT_COLUMNS
+        
+        rows = db.iter_deliveries(
+            service=request.args.get('service') or None,
+            is_active=active,
+            since=since,
+            until=until,
+            include_archived=bool(archived)
+        )
+        body = export.GENERATORS[fmt](EXPORT_COLUMNS, rows)
+        filename = f"deliveries-{datetime.now():%Y%m%d-%H%M%S}.{'csv' if fmt == 'csv' else 'ndjson'}"
+        return Response(
+            stream_with_context(body),
+            content_type=export.FORMATS[fmt],
+            headers={'Content-Disposition': f'attachment; filename={filename}'}
+        )
+    except Exception as e:
+        logger.error(f"❌ Ошибка: {e}")
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+
 @app.route('/mark_done/<order_number>', methods=['POST'])
 def mark_done(order_number):
     """Отметить доставку как забранную"""
@@ -0,0 +1,510 @@
+"""
+Бенчмарк пайплайна доставок на локальных фейках Gmail, OpenAI и Telegram
+
+Запуск:
+    python benchmark.py                          # 100, 1k и 10k писем
+    python benchmark.py --sizes 100 1000 --llm-latency-ms 5
+    python benchmark.py --compare old.json       # сравнить с прошлым прогоном
+    python benchmark.py --export-sizes 1000000   # выгрузка /export на 1M строк
+
+Каждый сценарий (путь x размер) выполняется в отдельном процессе,
+чтобы пиковый RSS не накапливался между прогонами.
+"""
+import argparse
+import asyncio
+import base64
+import json
+import logging
+import math
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from functools import wraps
+from multiprocessing import get_context
+from types import SimpleNamespace
+from typing import Dict, List
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SIZES = [100, 1000, 10000]
+PATHS = ["bot", "flask"]
+DEFAULT_EXPORT_SIZES = [10000, 100000]
+EXPORT_FORMATS = ["ndjson", "csv"]
+
+SERVICES = ["СДЭК", "Boxberry", "Почта России", "DPD", "Ozon", "Wildberries"]
+STATUSES = ["Создан", "В пути", "Прибыл в пункт выдачи", "Доставлен"]
+
+
+# ---------------------------------------------------------------------------
+# Фейки внешних сервисов
+# ---------------------------------------------------------------------------
+
+class _Request:
+    """Аналог HttpRequest из googleapiclient: execute() возвращает ответ"""
+
+    def __init__(self, func, latency: float):
+        self._func = func
+        self._latency = latency
+
+    def execute(self):
+        if self._latency:
+            time.sleep(self._latency)
+        return self._func()
+
+
+class FakeGmailService:
+    """Gmail API сервис, отдающий синтетический корпус писем"""
+
+    def __init__(self, size: int, latency_ms: float = 0.0, body_bytes: int = 2000):
+        self.latency = latency_ms / 1000
+        self.corpus = {}
+        self.requests = 0
+        self.bytes_served = 0
+        for i in range(size):
+            message = self._make_message(i, body_bytes)
+            self.corpus[message['id']] = message
+
+    @staticmethod
+    def _make_message(i: int, body_bytes: int) -> Dict:
+        service = SERVICES[i % len(SERVICES)]
+        status = STATUSES[i % len(STATUSES)]
+        text = (
+            f"Здравствуйте! Ваш заказ BENCH{i:08d} от {service}.\n"
+            f"Статус: {status}\n"
+            f"Адрес: г. Москва, ул. Тестовая, д. {i % 200}\n"
+            f"Код получения: {i % 10000:04d}\n"
+        )
+        text += "Спасибо, что выбираете нас! " * max(0, (body_bytes - len(text)) // 28)
+        return {
+            'id': f"msg{i:08d}",
+            'threadId': f"thr{i:08d}",
+            'snippet': text[:100],
+            'sizeEstimate': len(text.encode('utf-8')),
+            'internalDate': str(1700000000000 + i * 1000),
+            'payload': {
+                'headers': [
+                    {'name': 'Subject', 'value': f"{service}: заказ BENCH{i:08d} — {status}"},
+                    {'name': 'From', 'value': f"noreply@{service.lower()}.example"},
+                ],
+                'body': {'data': base64.urlsafe_b64encode(text.encode('utf-8')).decode('ascii')},
+            },
+        }
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def list(self, userId: str, q: str = None, **kwargs):
+        def _list():
+            self.requests += 1
+            return {'messages': [{'id': mid, 'threadId': m['threadId']} for mid, m in self.corpus.items()]}
+        return _Request(_list, self.latency)
+
+    def get(self, userId: str, id: str, **kwargs):
+        def _get():
+            self.requests += 1
+            message = self.corpus[id]
+            self.bytes_served += len(message['payload']['body']['data'])
+            return message
+        return _Request(_get, self.latency)
+
+
+class FakeOpenAI:
+    """Замена OpenAI клиента с настраиваемой задержкой и учётом токенов"""
+
+    def __init__(self, latency_ms: float = 0.0, delivery_ratio: float = 0.6):
+        self.latency = latency_ms / 1000
+        self.delivery_ratio = delivery_ratio
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    @staticmethod
+    def count_tokens(text: str) -> int:
+        """Грубая оценка: ~4 символа на токен"""
+        return max(1, math.ceil(len(text) / 4))
+
+    def _create(self, model: str, messages: List[Dict], max_tokens: int = None, **kwargs):
+        n = self.calls
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+        # Детерминированно: первые delivery_ratio писем из каждой сотни — доставки
+        is_delivery = (n % 100) < self.delivery_ratio * 100
+        content = json.dumps({
+            "is_delivery_email": is_delivery,
+            "delivery_service": SERVICES[n % len(SERVICES)] if is_delivery else None,
+            "order_number": f"BENCH{n:08d}" if is_delivery else None,
+            "delivery_address": f"г. Москва, ул. Тестовая, д. {n % 200}" if is_delivery else None,
+            "delivery_status": STATUSES[n % len(STATUSES)] if is_delivery else None,
+            "pickup_code": f"{n % 10000:04d}" if is_delivery else None,
+            "estimated_delivery": "2025-12-25" if is_delivery else None,
+            "recipient_name": "Иван Петров" if is_delivery else None,
+        }, ensure_ascii=False)
+
+        prompt_tokens = sum(self.count_tokens(m.get('content', '')) for m in messages)
+        completion_tokens = self.count_tokens(content)
+        self.prompt_tokens += prompt_tokens
+        self.completion_tokens += completion_tokens
+
+        return SimpleNamespace(
+            model=model,
+            choices=[SimpleNamespace(message=SimpleNamespace(role="assistant", content=content))],
+            usage=SimpleNamespace(
+                prompt_tokens=prompt_tokens,
+                completion_tokens=completion_tokens,
+                total_tokens=prompt_tokens + completion_tokens,
+            ),
+        )
+
+
+class FakeTelegramBot:
+    """Заглушка telegram.Bot: запоминает только число отправок"""
+
+    def __init__(self, latency_ms: float = 0.0):
+        self.latency = latency_ms / 1000
+        self.sent = 0
+
+    async def send_message(self, chat_id, text: str, parse_mode: str = None, **kwargs):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.sent += 1
+        return SimpleNamespace(message_id=self.sent, chat_id=chat_id)
+
+
+# ---------------------------------------------------------------------------
+# Измерения
+# ---------------------------------------------------------------------------
+
+class StageTimer:
+    """Собирает длительности вызовов по стадиям пайплайна"""
+
+    def __init__(self):
+        self.samples = {}
+
+    def record(self, stage: str, seconds: float):
+        self.samples.setdefault(stage, []).append(seconds)
+
+    def wrap(self, obj, method_name: str, stage: str):
+        """Подменить метод экземпляра на версию с замером времени"""
+        original = getattr(obj, method_name)
+
+        if asyncio.iscoroutinefunction(original):
+            @wraps(original)
+            async def timed(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await original(*args, **kwargs)
+                finally:
+                    self.record(stage, time.perf_counter() - start)
+        else:
+            @wraps(original)
+            def timed(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return original(*args, **kwargs)
+                finally:
+                    self.record(stage, time.perf_counter() - start)
+
+        setattr(obj, method_name, timed)
+
+    def summary(self) -> Dict:
+        """count и total_ms по стадиям; p50/p99 - только если вызовов больше одного"""
+        result = {}
+        for stage, values in self.samples.items():
+            values = sorted(values)
+            result[stage] = {
+                'count': len(values),
+                'total_ms': round(sum(values) * 1000, 3),
+            }
+            if len(values) > 1:
+                result[stage]['p50_ms'] = round(percentile(values, 50) * 1000, 4)
+                result[stage]['p99_ms'] = round(percentile(values, 99) * 1000, 4)
+        return result
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    """Перцентиль по методу ближайшего ранга"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(pct / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def peak_rss_mb() -> float:
+    """Пиковый RSS текущего процесса в МБ"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux отдаёт килобайты, macOS — байты
+    if sys.platform == 'darwin':
+        return round(peak / 1024 / 1024, 1)
+    return round(peak / 1024, 1)
+
+
+# ---------------------------------------------------------------------------
+# Сценарии
+# ---------------------------------------------------------------------------
+
+def _build_components(size: int, options: Dict, workdir: str):
+    """Собрать настоящие компоненты бота поверх фейков"""
+    from sqlalchemy import event
+    from database import DatabaseManager
+    from delivery_parser import DeliveryParser
+    from gmail_client import GmailClient
+    from telegram_bot import DeliveryTelegramBot
+
+    db = DatabaseManager(f"sqlite:///{os.path.join(workdir, 'bench.db')}")
+    statements = {'count': 0}
+
+    @event.listens_for(db.engine, "before_cursor_execute")
+    def _count_statement(conn, cursor, statement, parameters, context, executemany):
+        statements['count'] += 1
+
+    gmail_service = FakeGmailService(size, options['gmail_latency_ms'], options['body_bytes'])
+    gmail_client = GmailClient.__new__(GmailClient)
+    gmail_client.credentials_file = None
+    gmail_client.service = gmail_service
+
+    openai = FakeOpenAI(options['llm_latency_ms'], options['delivery_ratio'])
+    parser = DeliveryParser("bench-key", client=openai)
+
+    telegram = FakeTelegramBot(options['telegram_latency_ms'])
+    telegram_bot = DeliveryTelegramBot("bench-token", db)
+    telegram_bot.application = SimpleNamespace(bot=telegram)
+
+    fakes = SimpleNamespace(gmail=gmail_service, openai=openai, telegram=telegram, statements=statements)
+    return db, gmail_client, parser, telegram_bot, fakes
+
+
+def _instrument(timer: StageTimer, gmail_client, parser, db, telegram_bot):
+    # Стадии меряются по отдельным вызовам: каждый запрос к Gmail, каждое событие доставки;
+    # запись пачки событий вызывается раз за проверку и идёт отдельной стадией store_flush
+    timer.wrap(gmail_client, '_execute', 'fetch')
+    timer.wrap(parser, '_parse_prompt', 'parse')
+    timer.wrap(db, 'record_event', 'store')
+    timer.wrap(db, 'flush_events', 'store_flush')
+    timer.wrap(telegram_bot, 'send_message', 'notify')
+
+
+def run_scenario(path: str, size: int, options: Dict) -> Dict:
+    """Прогнать один сценарий и вернуть метрики"""
+    logging.disable(logging.WARNING)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        db, gmail_client, parser, telegram_bot, fakes = _build_components(size, options, workdir)
+        timer = StageTimer()
+        _instrument(timer, gmail_client, parser, db, telegram_bot)
+
+        if path == "bot":
+            from main import DeliveryBot
+            bot = DeliveryBot(db=db, gmail_client=gmail_client, parser=parser, telegram_bot=telegram_bot)
+            start = time.perf_counter()
+            processed = asyncio.run(bot.check_deliveries())
+            elapsed = time.perf_counter() - start
+        elif path == "flask":
+            import app as flask_app
+            flask_app.db = db
+            flask_app.gmail_client = gmail_client
+            flask_app.parser = parser
+            flask_app.telegram_bot = telegram_bot
+            client = flask_app.app.test_client()
+            start = time.perf_counter()
+            response = client.post('/check')
+            elapsed = time.perf_counter() - start
+            if response.status_code != 200:
+                raise RuntimeError(f"/check вернул {response.status_code}: {response.get_data(as_text=True)}")
+            processed = response.get_json()['count']
+        else:
+            raise ValueError(f"Неизвестный путь: {path}")
+
+        db.engine.dispose()
+
+    return {
+        'path': path,
+        'emails': size,
+        'deliveries': processed,
+        'elapsed_s': round(elapsed, 4),
+        'emails_per_sec': round(size / elapsed, 1) if elapsed else None,
+        'stages': timer.summary(),
+        'llm_calls_per_email': round(fakes.openai.calls / size, 4) if size else 0,
+        'llm_prompt_tokens': fakes.openai.prompt_tokens,
+        'llm_prompt_tokens_per_email': round(fakes.openai.prompt_tokens / fakes.openai.calls, 1) if fakes.openai.calls else None,
+        'llm_completion_tokens': fakes.openai.completion_tokens,
+        'gmail_requests': fakes.gmail.requests,
+        'gmail_bytes': fakes.gmail.bytes_served,
+        'telegram_sends': fakes.telegram.sent,
+        'db_statements': fakes.statements['count'],
+        'db_statements_per_delivery': round(fakes.statements['count'] / processed, 2) if processed else None,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def _populate_deliveries(db, rows: int, batch_size: int = 5000):
+    """Заполнить таблицу deliveries синтетическими строками"""
+    from sqlalchemy import insert
+    from database import Delivery
+
+    now = datetime.now()
+    for offset in range(0, rows, batch_size):
+        batch = [{
+            'order_number': f"EXP{i:010d}",
+            'service': SERVICES[i % len(SERVICES)],
+            'status': STATUSES[i % len(STATUSES)],
+            'address': f"г. Москва, ул. Тестовая, д. {i % 200}",
+            'pickup_code': f"{i % 10000:04d}",
+            'recipient_name': "Иван Петров",
+            'estimated_delivery': "2025-12-25",
+            'is_active': i % 3 != 0,
+            'created_at': now,
+            'updated_at': now,
+        } for i in range(offset, min(offset + batch_size, rows))]
+        with db.engine.begin() as conn:
+            conn.execute(insert(Delivery), batch)
+
+
+def run_export_scenario(fmt: str, rows: int) -> Dict:
+    """Выгрузить rows доставок через Flask /export и измерить скорость и память"""
+    logging.disable(logging.WARNING)
+    from database import DatabaseManager
+
+    with tempfile.TemporaryDirectory() as workdir:
+        db = DatabaseManager(f"sqlite:///{os.path.join(workdir, 'export.db')}")
+        _populate_deliveries(db, rows)
+
+        import app as flask_app
+        from config import Config
+        flask_app.db = db
+        Config.ADMIN_TOKEN = "bench-admin"
+        client = flask_app.app.test_client()
+        rss_before = peak_rss_mb()
+
+        start = time.perf_counter()
+        response = client.get(f'/export?format={fmt}', headers={'X-Admin-Token': Config.ADMIN_TOKEN},
+                              buffered=False)
+        if response.status_code != 200:
+            raise RuntimeError(f"/export вернул {response.status_code}")
+        exported_bytes = 0
+        chunks = 0
+        for chunk in response.iter_encoded():
+            exported_bytes += len(chunk)
+            chunks += 1
+        response.close()
+        elapsed = time.perf_counter() - start
+
+        db.engine.dispose()
+
+    return {
+        'format': fmt,
+        'rows': rows,
+        'elapsed_s': round(elapsed, 4),
+        'rows_per_sec': round(rows / elapsed, 1) if elapsed else None,
+        'mb_per_sec': round(exported_bytes / 1024 / 1024 / elapsed, 2) if elapsed else None,
+        'bytes': exported_bytes,
+        'chunks': chunks,
+        'peak_rss_before_export_mb': rss_before,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def run_all(paths: List[str], sizes: List[int], options: Dict, export_sizes: List[int] = ()) -> Dict:
+    """Прогнать все сценарии, каждый в свежем процессе"""
+    results = []
+    spawn = get_context("spawn")
+    for path in paths:
+        for size in sizes:
+            with ProcessPoolExecutor(max_workers=1, mp_context=spawn) as pool:
+                result = pool.submit(run_scenario, path, size, options).result()
+            results.append(result)
+            print(f"{path:>5} {size:>6} писем: {result['emails_per_sec']:>9} писем/с, "
+                  f"SQL/доставку {result['db_statements_per_delivery']}, "
+                  f"токенов промпта/письмо {result['llm_prompt_tokens_per_email']}, "
+                  f"RSS {result['peak_rss_mb']} МБ")
+
+    export_results = []
+    for fmt in EXPORT_FORMATS:
+        for rows in export_sizes:
+            with ProcessPoolExecutor(max_workers=1, mp_context=spawn) as pool:
+                result = pool.submit(run_export_scenario, fmt, rows).result()
+            export_results.append(result)
+            print(f"export {fmt:>6} {rows:>8} строк: {result['rows_per_sec']:>10} строк/с, "
+                  f"{result['mb_per_sec']} МБ/с, "
+                  f"RSS {result['peak_rss_before_export_mb']} -> {result['peak_rss_mb']} МБ")
+
+    return {
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'options': options,
+        'results': results,
+        'export': export_results,
+    }
+
+
+def compare(current: Dict, baseline: Dict):
+    """Напечатать изменение пропускной способности относительно прошлого прогона"""
+    previous = {(r['path'], r['emails']): r for r in baseline.get('results', [])}
+    print(f"\nСравнение с прогоном от {baseline.get('created_at', '?')}:")
+    for result in current['results']:
+        old = previous.get((result['path'], result['emails']))
+        if not old or not old.get('emails_per_sec'):
+            continue
+        delta = (result['emails_per_sec'] / old['emails_per_sec'] - 1) * 100
+        print(f"{result['path']:>5} {result['emails']:>6} писем: "
+              f"{old['emails_per_sec']} -> {result['emails_per_sec']} писем/с ({delta:+.1f}%), "
+              f"токенов промпта/письмо {old.get('llm_prompt_tokens_per_email')} -> "
+              f"{result['llm_prompt_tokens_per_email']}, "
+              f"RSS {old['peak_rss_mb']} -> {result['peak_rss_mb']} МБ")
+
+    previous_export = {(r['format'], r['rows']): r for r in baseline.get('export', [])}
+    for result in current.get('export', []):
+        old = previous_export.get((result['format'], result['rows']))
+        if not old or not old.get('rows_per_sec'):
+            continue
+        delta = (result['rows_per_sec'] / old['rows_per_sec'] - 1) * 100
+        print(f"export {result['format']:>6} {result['rows']:>8} строк: "
+              f"{old['rows_per_sec']} -> {result['rows_per_sec']} строк/с ({delta:+.1f}%)")
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Бенчмарк пайплайна доставок")
+    arg_parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES)
+    arg_parser.add_argument('--paths', nargs='+', choices=PATHS, default=PATHS)
+    arg_parser.add_argument('--gmail-latency-ms', type=float, default=0.0)
+    arg_parser.add_argument('--llm-latency-ms', type=float, default=0.0)
+    arg_parser.add_argument('--telegram-latency-ms', type=float, default=0.0)
+    arg_parser.add_argument('--delivery-ratio', type=float, default=0.6)
+    arg_parser.add_argument('--body-bytes', type=int, default=2000)
+    arg_parser.add_argument('--export-sizes', type=int, nargs='*', default=DEFAULT_EXPORT_SIZES,
+                            help="Сколько строк выгружать через /export (без значений - пропустить)")
+    arg_parser.add_argument('--output', default='benchmark_results.json')
+    arg_parser.add_argument('--compare', help="JSON прошлого прогона для сравнения")
+    args = arg_parser.parse_args()
+
+    options = {
+        'gmail_latency_ms': args.gmail_latency_ms,
+        'llm_latency_ms': args.llm_latency_ms,
+        'telegram_latency_ms': args.telegram_latency_ms,
+        'delivery_ratio': args.delivery_ratio,
+        'body_bytes': args.body_bytes,
+    }
+    report = run_all(args.paths, args.sizes, options, args.export_sizes)
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\n💾 Результаты сохранены в {args.output}")
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            compare(report, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -71,6 +71,15 @@ class Config:
     # OpenAI Configuration
     OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY", "")
     
+    # LLM Configuration (бюджеты в токенах, 0 - без ограничения)
+    LLM_MODEL = os.environ.get("LLM_MODEL", "gpt-4o-mini")
+    LLM_CHEAP_MODEL = os.environ.get("LLM_CHEAP_MODEL", "")
+    LLM_SHORT_EMAIL_TOKENS = int(os.environ.get("LLM_SHORT_EMAIL_TOKENS", "400"))
+    LLM_MAX_TOKENS = int(os.environ.get("LLM_MAX_TOKENS", "500"))
+    LLM_RUN_TOKEN_BUDGET = int(os.environ.get("LLM_RUN_TOKEN_BUDGET", "0"))
+    LLM_DAILY_TOKEN_BUDGET = int(os.environ.get("LLM_DAILY_TOKEN_BUDGET", "0"))
+    LLM_DEFERRED_MAX_DAYS = int(os.environ.get("LLM_DEFERRED_MAX_DAYS", "3"))
+    
     # Telegram Configuration
     TELEGRAM_BOT_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN", "")
     TELEGRAM_CHAT_ID = os.environ.get("TELEGRAM_CHAT_ID", "0")
@@ -82,6 +91,11 @@ class Config:
     # Database Configuration
     DATABASE_URL = os.environ.get("DATABASE_URL", "sqlite:///deliveries.db")
     
+    # Retention Configuration (0 - шаг выключен)
+    RETENTION_STALE_DAYS = int(os.environ.get("RETENTION_STALE_DAYS", "30"))
+    RETENTION_ARCHIVE_DAYS = int(os.environ.get("RETENTION_ARCHIVE_DAYS", "90"))
+    RETENTION_BATCH_SIZE = int(os.environ.get("RETENTION_BATCH_SIZE", "500"))
+    
     # Bot Configuration
     CHECK_INTERVAL_HOURS = int(os.environ.get("CHECK_INTERVAL_HOURS", "24"))
     DAILY_CHECK_TIME = os.environ.get("DAILY_CHECK_TIME", "09:00")
@@ -89,6 +103,12 @@ class Config:
     # Google Cloud Configuration
     GCP_PROJECT_ID = os.environ.get("GCP_PROJECT_ID", "")
     
+    # Admin / Profiling Configuration
+    ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")
+    PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", "0"))
+    PROFILE_DIR = os.environ.get("PROFILE_DIR", "/tmp/profiles")
+    PROFILE_KEEP = int(os.environ.get("PROFILE_KEEP", "20"))
+    
     @classmethod
     def validate(cls):
         """Проверить что все необходимые конфиги установлены"""
@@ -1,15 +1,99 @@
 """
 База данных для хранения доставок
 """
-from sqlalchemy import create_engine, Column, String, DateTime, Boolean, Integer, Text
+from sqlalchemy import create_engine, event, func, inspect, select, case, or_, text, insert, update, delete, Column, String, DateTime, Boolean, Integer, Text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
-from datetime import datetime
+from datetime import datetime, timedelta
+from typing import Iterator, NamedTuple, Optional
+import json
 import logging
+import re
+import threading
+import time
+import metrics
 
 logger = logging.getLogger(__name__)
 Base = declarative_base()
 
+DB_QUERY_LATENCY = metrics.histogram(
+    'db_query_seconds', 'Длительность SQL-запроса', ['operation'],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+)
+DB_ROWS_WRITTEN = metrics.counter('db_rows_written_total', 'Записанные строки', ['operation'])
+EVENTS_FLUSHED = metrics.counter('delivery_events_flushed_total', 'Записанные события доставок')
+RETENTION_ROWS = metrics.counter('retention_rows_total', 'Доставки, обработанные ретеншеном', ['action'])
+
+WRITE_OPERATIONS = ('INSERT', 'UPDATE', 'DELETE')
+
+# Полнотекстовый поиск: индексируемые поля доставки
+SEARCH_COLUMNS = ('order_number', 'service', 'status', 'address', 'recipient_name')
+MAX_SEARCH_TERMS = 8
+
+# Текущие доставки и архив индексируются одинаково: /find ищет и по старым заказам
+SEARCH_TABLES = ('deliveries', 'deliveries_archive')
+
+
+def _sqlite_fts_ddl(table: str, fts: str, columns: tuple, options: str) -> list:
+    """FTS5 с внешним содержимым table, синхронизируется триггерами на каждой записи"""
+    cols = ', '.join(columns)
+    new = ', '.join(f'new.{c}' for c in columns)
+    old = ', '.join(f'old.{c}' for c in columns)
+    return [
+        f"""CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5(
+            {cols}, content='{table}', content_rowid='id', {options}
+        )""",
+        f"""CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON {table} BEGIN
+            INSERT INTO {fts}(rowid, {cols}) VALUES (new.id, {new});
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON {table} BEGIN
+            INSERT INTO {fts}({fts}, rowid, {cols}) VALUES ('delete', old.id, {old});
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE OF {cols} ON {table} BEGIN
+            INSERT INTO {fts}({fts}, rowid, {cols}) VALUES ('delete', old.id, {old});
+            INSERT INTO {fts}(rowid, {cols}) VALUES (new.id, {new});
+        END""",
+    ]
+
+
+# SQLite: FTS5 по словам (таблицы <table>_fts)
+SQLITE_SEARCH_DDL = {
+    table: _sqlite_fts_ddl(table, f'{table}_fts', SEARCH_COLUMNS,
+                           "tokenize='unicode61 remove_diacritics 2', prefix='2 3'")
+    for table in SEARCH_TABLES
+}
+
+# PostgreSQL: GIN-индекс по tsvector-выражению, Postgres обновляет его сам
+PG_SEARCH_VECTOR = "to_tsvector('simple', " + " || ' ' || ".join(
+    f"coalesce({c}, '')" for c in SEARCH_COLUMNS
+) + ")"
+PG_SEARCH_DDL = [
+    f"CREATE INDEX IF NOT EXISTS ix_{table}_search ON {table} USING GIN ({PG_SEARCH_VECTOR})"
+    for table in SEARCH_TABLES
+]
+
+# Поиск по части номера заказа: триграммный индекс вместо полного скана по LIKE '%...%'
+SQLITE_ORDER_SEARCH_DDL = {
+    table: _sqlite_fts_ddl(table, f'{table}_order_fts', ('order_number',), "tokenize='trigram'")
+    for table in SEARCH_TABLES
+}
+# PostgreSQL: с gin_trgm_ops обычный ILIKE '%...%' идёт по индексу
+PG_ORDER_SEARCH_DDL = ["CREATE EXTENSION IF NOT EXISTS pg_trgm"] + [
+    f"CREATE INDEX IF NOT EXISTS ix_{table}_order_trgm ON {table} USING GIN (order_number gin_trgm_ops)"
+    for table in SEARCH_TABLES
+]
+
+# Колонки, добавленные после первого релиза: create_all не меняет уже существующие таблицы
+ADDED_COLUMNS = {
+    'deliveries': {'auto_completed': 'BOOLEAN DEFAULT FALSE'},
+    'deliveries_archive': {'auto_completed': 'BOOLEAN DEFAULT FALSE'},
+}
+
+
+def search_terms(query: str) -> list:
+    """Разбить запрос на слова (только буквы и цифры, без операторов FTS)"""
+    return re.findall(r'\w+', query.lower())[:MAX_SEARCH_TERMS]
+
 
 class Delivery(Base):
     """Модель доставки"""
@@ -24,62 +108,506 @@ class Delivery(Base):
     recipient_name = Column(String(100), nullable=True)
     estimated_delivery = Column(String(50), nullable=True)
     is_active = Column(Boolean, default=True)
+    # Завершена ретеншеном, а не пользователем: новое письмо снова делает её активной
+    auto_completed = Column(Boolean, default=False)
     created_at = Column(DateTime, default=datetime.now)
     updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now)
 
 
+class DeliveryRow(NamedTuple):
+    """Компактная строка доставки для чтения (без ORM)"""
+    service: str
+    order_number: str
+    status: str
+    address: Optional[str]
+    pickup_code: Optional[str]
+
+
+DELIVERY_ROW_COLUMNS = [getattr(Delivery, field) for field in DeliveryRow._fields]
+
+
+class DeliveryArchive(Base):
+    """Завершённая доставка, перенесённая из горячей таблицы"""
+    __tablename__ = 'deliveries_archive'
+    
+    id = Column(Integer, primary_key=True)
+    delivery_id = Column(Integer, nullable=False)
+    order_number = Column(String(100), nullable=False, index=True)
+    service = Column(String(50), nullable=False)
+    status = Column(String(100), nullable=False)
+    address = Column(Text, nullable=True)
+    pickup_code = Column(String(50), nullable=True)
+    recipient_name = Column(String(100), nullable=True)
+    estimated_delivery = Column(String(50), nullable=True)
+    is_active = Column(Boolean, default=False)
+    auto_completed = Column(Boolean, default=False)
+    created_at = Column(DateTime, nullable=True)
+    updated_at = Column(DateTime, nullable=True)
+    archived_at = Column(DateTime, default=datetime.now)
+
+
+class DeliveryRollup(Base):
+    """Предрассчитанные счётчики архива по сервисам (для статистики)"""
+    __tablename__ = 'delivery_rollup'
+    
+    service = Column(String(50), primary_key=True)
+    archived = Column(Integer, nullable=False, default=0)
+
+
+EXPORT_COLUMNS = [column.name for column in Delivery.__table__.columns]
+ARCHIVED_COLUMNS = [column.name for column in Delivery.__table__.columns if column.name != 'id']
+
+
+class DeliveryEvent(Base):
+    """Событие доставки из одного письма (только добавление, без изменений)"""
+    __tablename__ = 'delivery_events'
+    
+    id = Column(Integer, primary_key=True)
+    order_number = Column(String(100), nullable=False, index=True)
+    message_id = Column(String(100), nullable=True, index=True)
+    service = Column(String(50), nullable=True)
+    status = Column(String(100), nullable=True)
+    address = Column(Text, nullable=True)
+    pickup_code = Column(String(50), nullable=True)
+    recipient_name = Column(String(100), nullable=True)
+    estimated_delivery = Column(String(50), nullable=True)
+    occurred_at = Column(DateTime, nullable=False)
+    created_at = Column(DateTime, default=datetime.now)
+
+
+EVENT_FIELDS = ('order_number', 'service', 'status', 'address', 'pickup_code', 'recipient_name', 'estimated_delivery')
+
+# Парсер отдаёт delivery_service / delivery_status / delivery_address
+FIELD_ALIASES = {'service': 'delivery_service', 'status': 'delivery_status', 'address': 'delivery_address'}
+
+# Ограничение на размер IN (...) в одном запросе
+IN_CHUNK_SIZE = 500
+
+
+def normalize_delivery(delivery_data: dict) -> dict:
+    """Привести данные доставки (из парсера или API) к полям событий"""
+    event = {}
+    for field in EVENT_FIELDS:
+        value = delivery_data.get(field)
+        if value is None and field in FIELD_ALIASES:
+            value = delivery_data.get(FIELD_ALIASES[field])
+        event[field] = str(value) if value is not None else None
+    
+    event['message_id'] = delivery_data.get('message_id')
+    received_at = delivery_data.get('received_at')
+    if isinstance(received_at, datetime):
+        event['occurred_at'] = received_at
+    elif received_at:
+        # internalDate из Gmail - миллисекунды с эпохи
+        event['occurred_at'] = datetime.fromtimestamp(int(received_at) / 1000)
+    else:
+        event['occurred_at'] = datetime.now()
+    return event
+
+
+def _chunks(items: list, size: int = IN_CHUNK_SIZE):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+class LlmUsage(Base):
+    """Расход токенов LLM за одну проверку"""
+    __tablename__ = 'llm_usage'
+    
+    id = Column(Integer, primary_key=True)
+    calls = Column(Integer, default=0)
+    prompt_tokens = Column(Integer, default=0)
+    completion_tokens = Column(Integer, default=0)
+    deferred = Column(Integer, default=0)
+    models = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.now, index=True)
+
+
+class DeferredEmail(Base):
+    """Письмо, отложенное до следующей проверки из-за бюджета токенов"""
+    __tablename__ = 'deferred_emails'
+    
+    message_id = Column(String(100), primary_key=True)
+    deferred_at = Column(DateTime, default=datetime.now)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # Время старта хранится на контексте запроса: при ошибке он просто отбрасывается
+    if context is not None:
+        context._query_start = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = getattr(context, '_query_start', None)
+    if start is None:
+        return
+    elapsed = time.perf_counter() - start
+    operation = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else 'OTHER'
+    DB_QUERY_LATENCY.labels(operation=operation).observe(elapsed)
+    if operation in WRITE_OPERATIONS and cursor.rowcount > 0:
+        DB_ROWS_WRITTEN.labels(operation=operation).inc(cursor.rowcount)
+
+
 class DatabaseManager:
     """Менеджер базы данных"""
     
     def __init__(self, database_url: str):
         self.engine = create_engine(database_url, echo=False)
+        event.listen(self.engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(self.engine, "after_cursor_execute", _after_cursor_execute)
         Base.metadata.create_all(self.engine)
+        self._add_missing_columns()
         self.Session = sessionmaker(bind=self.engine)
+        self.search_backend = self._setup_search()
+        self.order_search_backend = self._setup_order_search()
+        self._event_buffer = []
+        self._buffer_lock = threading.Lock()
+        self.failed_orders = set()
+    
+    def _add_missing_columns(self):
+        """Добавить в таблицы старых БД колонки из ADDED_COLUMNS"""
+        inspector = inspect(self.engine)
+        with self.engine.begin() as conn:
+            for table, columns in ADDED_COLUMNS.items():
+                existing = {column['name'] for column in inspector.get_columns(table)}
+                for name, ddl in columns.items():
+                    if name not in existing:
+                        conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {name} {ddl}"))
+                        logger.info(f"🛠️ В таблицу {table} добавлена колонка {name}")
+    
+    def _setup_search(self) -> str:
+        """Создать полнотекстовый индекс для диалекта БД, вернуть имя бэкенда"""
+        dialect = self.engine.dialect.name
+        try:
+            with self.engine.begin() as conn:
+                if dialect == 'sqlite':
+                    self._create_sqlite_fts(conn, SQLITE_SEARCH_DDL, '_fts')
+                    return 'fts5'
+                if dialect == 'postgresql':
+                    for ddl in PG_SEARCH_DDL:
+                        conn.execute(text(ddl))
+                    return 'tsvector'
+        except Exception as e:
+            logger.warning(f"⚠️ Полнотекстовый индекс недоступен, поиск будет через LIKE: {e}")
+        return 'like'
+    
+    @staticmethod
+    def _create_sqlite_fts(conn, ddl_by_table: dict, suffix: str):
+        """Создать FTS5-таблицы с триггерами; новые таблицы заполнить уже сохранёнными строками"""
+        for table, statements in ddl_by_table.items():
+            fts = f'{table}{suffix}'
+            exists = conn.execute(text("SELECT 1 FROM sqlite_master WHERE name = :name"), {'name': fts}).first()
+            for ddl in statements:
+                conn.execute(text(ddl))
+            if not exists:
+                conn.execute(text(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')"))
+    
+    def _setup_order_search(self) -> str:
+        """Создать триграммный индекс по номеру заказа, вернуть имя бэкенда"""
+        dialect = self.engine.dialect.name
+        try:
+            with self.engine.begin() as conn:
+                if dialect == 'sqlite':
+                    self._create_sqlite_fts(conn, SQLITE_ORDER_SEARCH_DDL, '_order_fts')
+                    return 'trigram'
+                if dialect == 'postgresql':
+                    for ddl in PG_ORDER_SEARCH_DDL:
+                        conn.execute(text(ddl))
+                    return 'trigram'
+        except Exception as e:
+            logger.warning(f"⚠️ Триграммный индекс недоступен, часть номера будет искаться полным сканом: {e}")
+        return 'like'
     
     def add_delivery(self, delivery_data: dict) -> bool:
-        """Добавить доставку"""
+        """Добавить доставку (записать событие и сразу сбросить буфер)"""
+        if not self.record_event(delivery_data):
+            return False
+        return self.flush_events() is not None and not self.failed_orders
+    
+    def record_event(self, delivery_data: dict) -> bool:
+        """Положить событие доставки в буфер, запись в БД - в flush_events"""
+        event = normalize_delivery(delivery_data)
+        if not event['order_number']:
+            logger.warning("⚠️ Доставка без номера заказа пропущена")
+            return False
+        with self._buffer_lock:
+            self._event_buffer.append(event)
+        return True
+    
+    def flush_events(self) -> Optional[int]:
+        """
+        Записать накопленные события одной транзакцией и обновить
+        текущее состояние доставок (таблица deliveries) по самым свежим из них.
+        
+        Письмо, уже записанное раньше (тот же message_id и номер), повторно
+        не записывается. Если пачка не записалась, заказы пишутся по одному:
+        заказы с ошибкой попадают в self.failed_orders, остальные сохраняются.
+        Возвращает число новых событий; None, если БД недоступна - тогда
+        события возвращаются в буфер до следующего вызова.
+        """
+        with self._buffer_lock:
+            events, self._event_buffer = self._event_buffer, []
+        self.failed_orders = set()
+        if not events:
+            return 0
+        
         session = self.Session()
         try:
-            existing = session.query(Delivery).filter_by(
-                order_number=delivery_data['order_number']
-            ).first()
+            # Отбрасываем письма, уже попавшие в журнал прошлыми проверками
+            seen = set()
+            message_ids = list({e['message_id'] for e in events if e['message_id']})
+            for chunk in _chunks(message_ids):
+                seen.update(session.execute(
+                    select(DeliveryEvent.order_number, DeliveryEvent.message_id)
+                    .where(DeliveryEvent.message_id.in_(chunk))
+                ).all())
+            by_order = {}
+            for e in events:
+                key = (e['order_number'], e['message_id'])
+                if e['message_id'] and key in seen:
+                    continue
+                seen.add(key)
+                by_order.setdefault(e['order_number'], []).append(e)
+            if not by_order:
+                return 0
             
-            if existing:
-                existing.status = delivery_data.get('status', existing.status)
-                existing.address = delivery_data.get('address', existing.address)
-                existing.pickup_code = delivery_data.get('pickup_code', existing.pickup_code)
-                existing.estimated_delivery = delivery_data.get('estimated_delivery', existing.estimated_delivery)
-                existing.updated_at = datetime.now()
+            try:
+                self._write_events(session, [e for order_events in by_order.values() for e in order_events])
                 session.commit()
-                return True
+            except Exception as e:
+                session.rollback()
+                logger.warning(f"⚠️ Пачка событий не записалась, пишу по одному заказу: {e}")
+                for order_number, order_events in by_order.items():
+                    try:
+                        self._write_events(session, order_events)
+                        session.commit()
+                    except Exception as e:
+                        session.rollback()
+                        self.failed_orders.add(order_number)
+                        logger.error(f"❌ Ошибка при сохранении доставки {order_number}: {e}")
             
-            delivery = Delivery(
-                order_number=delivery_data['order_number'],
-                service=delivery_data.get('service', 'Неизвестно'),
-                status=delivery_data.get('status', 'Неизвестно'),
-                address=delivery_data.get('address'),
-                pickup_code=delivery_data.get('pickup_code'),
-                recipient_name=delivery_data.get('recipient_name'),
-                estimated_delivery=delivery_data.get('estimated_delivery')
-            )
-            session.add(delivery)
-            session.commit()
-            return True
+            written = sum(len(order_events) for order_number, order_events in by_order.items()
+                          if order_number not in self.failed_orders)
+            EVENTS_FLUSHED.inc(written)
+            return written
         except Exception as e:
             logger.error(f"❌ Ошибка при добавлении доставки: {e}")
             session.rollback()
-            return False
+            # Уже записанные события при повторе отсеются по message_id
+            with self._buffer_lock:
+                self._event_buffer[:0] = events
+            return None
+        finally:
+            session.close()
+    
+    def _write_events(self, session, new_events: list):
+        """Добавить события в журнал и применить их к deliveries (без commit)"""
+        # Состояние по каждому заказу: поля более свежих событий перекрывают старые
+        latest = {}
+        for e in sorted(new_events, key=lambda e: e['occurred_at']):
+            state = latest.setdefault(e['order_number'], {})
+            state.update((field, value) for field, value in e.items() if value is not None)
+        
+        orders = list(latest)
+        last_seen = {}
+        existing = {}
+        for chunk in _chunks(orders):
+            last_seen.update(session.execute(
+                select(DeliveryEvent.order_number, func.max(DeliveryEvent.occurred_at))
+                .where(DeliveryEvent.order_number.in_(chunk))
+                .group_by(DeliveryEvent.order_number)
+            ).all())
+            existing.update(
+                (d.order_number, d)
+                for d in session.query(Delivery).filter(Delivery.order_number.in_(chunk))
+            )
+        archived = {}
+        for chunk in _chunks([order for order in orders if order not in existing]):
+            for row in session.query(DeliveryArchive).filter(
+                DeliveryArchive.order_number.in_(chunk)
+            ).order_by(DeliveryArchive.archived_at):
+                archived.setdefault(row.order_number, []).append(row)
+        
+        session.execute(insert(DeliveryEvent), new_events)
+        
+        now = datetime.now()
+        for order_number, state in latest.items():
+            # Письма старше уже учтённых не перетирают текущее состояние
+            if order_number in last_seen and state['occurred_at'] < last_seen[order_number]:
+                continue
+            delivery = existing.get(order_number)
+            if delivery is None and order_number in archived:
+                # Письмо по заказу из архива: возвращаем его, чтобы заказ не посчитался дважды
+                delivery = self._restore_archived(session, archived[order_number])
+            if delivery is None:
+                session.add(Delivery(
+                    order_number=order_number,
+                    service=state.get('service', 'Неизвестно'),
+                    status=state.get('status', 'Неизвестно'),
+                    address=state.get('address'),
+                    pickup_code=state.get('pickup_code'),
+                    recipient_name=state.get('recipient_name'),
+                    estimated_delivery=state.get('estimated_delivery')
+                ))
+                continue
+            for field in ('status', 'address', 'pickup_code', 'estimated_delivery'):
+                if field in state:
+                    setattr(delivery, field, state[field])
+            if delivery.auto_completed:
+                # Доставку закрыл ретеншен, а письмо пришло новое - она снова активна.
+                # Закрытые пользователем (/mark_done) остаются закрытыми
+                delivery.is_active = True
+                delivery.auto_completed = False
+            delivery.updated_at = now
+    
+    def _restore_archived(self, session, rows: list) -> Delivery:
+        """Вернуть доставку из архива в deliveries (по самой свежей архивной копии)"""
+        delivery = Delivery(**{name: getattr(rows[-1], name) for name in ARCHIVED_COLUMNS})
+        session.add(delivery)
+        for row in rows:
+            session.execute(
+                update(DeliveryRollup)
+                .where(DeliveryRollup.service == row.service)
+                .values(archived=DeliveryRollup.archived - 1)
+            )
+            session.delete(row)
+        RETENTION_ROWS.labels(action='restored').inc()
+        return delivery
+    
+    def get_delivery_history(self, order_number: str) -> list:
+        """События доставки в хронологическом порядке"""
+        session = self.Session()
+        try:
+            return session.query(DeliveryEvent).filter_by(order_number=order_number).order_by(
+                DeliveryEvent.occurred_at, DeliveryEvent.id
+            ).all()
         finally:
             session.close()
     
     def get_active_deliveries(self) -> list:
-        """Получить активные доставки"""
+        """Получить активные доставки (ORM-объекты; для чтения - iter_active_deliveries)"""
         session = self.Session()
         try:
             return session.query(Delivery).filter_by(is_active=True).all()
         finally:
             session.close()
     
+    def iter_active_deliveries(self, batch_size: int = 500) -> Iterator[DeliveryRow]:
+        """Активные доставки компактными строками, порциями по batch_size"""
+        query = (
+            select(*DELIVERY_ROW_COLUMNS)
+            .where(Delivery.is_active.is_(True))
+            .order_by(Delivery.id)
+        )
+        # Core-соединение вместо Session: без identity map и гидратации ORM
+        with self.engine.connect() as conn:
+            for row in conn.execution_options(yield_per=batch_size).execute(query):
+                yield DeliveryRow._make(row)
+    
+    def iter_deliveries(self, service: str = None, is_active: bool = None, since: datetime = None,
+                        until: datetime = None, include_archived: bool = False,
+                        batch_size: int = 1000) -> Iterator[tuple]:
+        """
+        Все поля доставок (в порядке EXPORT_COLUMNS) для выгрузки.
+        
+        Строки читаются серверным курсором порциями по batch_size,
+        так что память не зависит от размера выборки. С include_archived
+        после архива (id - исходный id доставки) идут текущие доставки.
+        """
+        current = Delivery.__table__.c
+        sources = [(current, list(current), current.id)]
+        if include_archived:
+            archive = DeliveryArchive.__table__.c
+            columns = [archive.delivery_id.label('id')] + [archive[name] for name in ARCHIVED_COLUMNS]
+            sources.insert(0, (archive, columns, archive.delivery_id))
+        
+        with self.engine.connect() as conn:
+            for table, columns, order in sources:
+                query = select(*columns).order_by(order)
+                if service:
+                    query = query.where(table.service == service)
+                if is_active is not None:
+                    query = query.where(table.is_active.is_(is_active))
+                if since:
+                    query = query.where(table.created_at >= since)
+                if until:
+                    query = query.where(table.created_at < until)
+                result = conn.execution_options(stream_results=True, yield_per=batch_size).execute(query)
+                for row in result:
+                    yield tuple(row)
+    
+    def search_deliveries(self, query: str, limit: int = 20) -> list:
+        """
+        Найти доставки по номеру, сервису, статусу, адресу или получателю.
+        
+        Слова запроса ищутся по префиксу и объединяются через И, результаты
+        ранжируются по релевантности. Номер заказа дополнительно ищется
+        по подстроке (например, по последним цифрам) через триграммный индекс.
+        Сначала идут текущие доставки, затем заархивированные.
+        """
+        terms = search_terms(query)
+        if not terms:
+            return []
+        order_terms = [term for term in terms if any(ch.isdigit() for ch in term) and len(term) >= 3]
+        
+        results = []
+        found = set()
+        with self.engine.connect() as conn:
+            for table in SEARCH_TABLES:
+                for row in self._search_table(conn, table, terms, order_terms, limit - len(results)):
+                    if row.order_number not in found:
+                        found.add(row.order_number)
+                        results.append(row)
+                if len(results) >= limit:
+                    break
+        return results[:limit]
+    
+    def _search_table(self, conn, table: str, terms: list, order_terms: list, limit: int) -> list:
+        """Поиск в одной таблице (deliveries или deliveries_archive)"""
+        columns = Base.metadata.tables[table].c
+        row_columns = [columns[field] for field in DeliveryRow._fields]
+        if self.search_backend == 'fts5':
+            fts = f'{table}_fts'
+            rows = conn.execute(text(
+                "SELECT d.service, d.order_number, d.status, d.address, d.pickup_code "
+                f"FROM {fts} JOIN {table} d ON d.id = {fts}.rowid "
+                f"WHERE {fts} MATCH :match ORDER BY bm25({fts}) LIMIT :limit"
+            ), {'match': ' '.join(f'"{term}"*' for term in terms), 'limit': limit}).all()
+        elif self.search_backend == 'tsvector':
+            rows = conn.execute(text(
+                f"SELECT service, order_number, status, address, pickup_code FROM {table} "
+                f"WHERE {PG_SEARCH_VECTOR} @@ to_tsquery('simple', :tsquery) "
+                f"ORDER BY ts_rank({PG_SEARCH_VECTOR}, to_tsquery('simple', :tsquery)) DESC LIMIT :limit"
+            ), {'tsquery': ' & '.join(f'{term}:*' for term in terms), 'limit': limit}).all()
+        else:
+            conditions = [
+                or_(*(columns[column].ilike(f'%{term}%') for column in SEARCH_COLUMNS))
+                for term in terms
+            ]
+            rows = conn.execute(
+                select(*row_columns).where(*conditions).order_by(columns.id.desc()).limit(limit)
+            ).all()
+        results = [DeliveryRow._make(row) for row in rows]
+        
+        # Частичное совпадение номера заказа, которое не ловит префиксный поиск
+        if order_terms and len(results) < limit:
+            if self.order_search_backend == 'trigram' and self.engine.dialect.name == 'sqlite':
+                fts = f'{table}_order_fts'
+                partial = conn.execute(text(
+                    "SELECT d.service, d.order_number, d.status, d.address, d.pickup_code "
+                    f"FROM {fts} JOIN {table} d ON d.id = {fts}.rowid "
+                    f"WHERE {fts} MATCH :match ORDER BY d.id DESC LIMIT :limit"
+                ), {'match': ' OR '.join(f'"{term}"' for term in order_terms), 'limit': limit}).all()
+            else:
+                partial = conn.execute(
+                    select(*row_columns)
+                    .where(or_(*(columns.order_number.ilike(f'%{term}%') for term in order_terms)))
+                    .order_by(columns.id.desc())
+                    .limit(limit)
+                ).all()
+            results += [DeliveryRow._make(row) for row in partial]
+        return results
+    
     def mark_as_inactive(self, order_number: str) -> bool:
         """Отметить как неактивную"""
         session = self.Session()
@@ -87,6 +615,7 @@ class DatabaseManager:
             delivery = session.query(Delivery).filter_by(order_number=order_number).first()
             if delivery:
                 delivery.is_active = False
+                delivery.auto_completed = False
                 delivery.updated_at = datetime.now()
                 session.commit()
                 return True
@@ -115,23 +644,185 @@ class DatabaseManager:
         finally:
             session.close()
     
+    def save_llm_usage(self, usage: dict) -> bool:
+        """Сохранить расход токенов за проверку"""
+        session = self.Session()
+        try:
+            session.add(LlmUsage(
+                calls=usage['calls'],
+                prompt_tokens=usage['prompt_tokens'],
+                completion_tokens=usage['completion_tokens'],
+                deferred=usage['deferred'],
+                models=json.dumps(usage['models'], ensure_ascii=False)
+            ))
+            session.commit()
+            return True
+        except Exception as e:
+            logger.error(f"❌ Ошибка при сохранении расхода токенов: {e}")
+            session.rollback()
+            return False
+        finally:
+            session.close()
+    
+    def get_tokens_used_today(self) -> int:
+        """Сколько токенов потрачено с начала суток"""
+        session = self.Session()
+        try:
+            midnight = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+            total = session.query(
+                func.coalesce(func.sum(LlmUsage.prompt_tokens + LlmUsage.completion_tokens), 0)
+            ).filter(LlmUsage.created_at >= midnight).scalar()
+            return int(total)
+        finally:
+            session.close()
+    
+    def get_deferred_email_ids(self) -> list:
+        """ID писем, отложенных прошлыми проверками (сначала самые старые)"""
+        session = self.Session()
+        try:
+            rows = session.query(DeferredEmail.message_id).order_by(DeferredEmail.deferred_at).all()
+            return [row.message_id for row in rows]
+        finally:
+            session.close()
+    
+    def set_deferred_email_ids(self, message_ids: list, max_age_days: int = 0) -> bool:
+        """
+        Заменить список отложенных писем.
+        
+        Письмо, отложенное повторно, сохраняет исходное время откладывания;
+        письма старше max_age_days дней больше не откладываются.
+        """
+        session = self.Session()
+        try:
+            deferred_at = dict(session.query(DeferredEmail.message_id, DeferredEmail.deferred_at).all())
+            now = datetime.now()
+            cutoff = now - timedelta(days=max_age_days) if max_age_days else None
+            keep = {}
+            dropped = 0
+            for message_id in message_ids:
+                since = deferred_at.get(message_id) or now
+                if cutoff and since < cutoff:
+                    dropped += 1
+                    continue
+                keep[message_id] = since
+            session.query(DeferredEmail).delete()
+            session.add_all(DeferredEmail(message_id=message_id, deferred_at=since) for message_id, since in keep.items())
+            session.commit()
+            if dropped:
+                logger.warning(f"⚠️ Пропущено писем, отложенных дольше {max_age_days} дн.: {dropped}")
+            return True
+        except Exception as e:
+            logger.error(f"❌ Ошибка при сохранении отложенных писем: {e}")
+            session.rollback()
+            return False
+        finally:
+            session.close()
+    
+    def complete_stale_deliveries(self, days: int, batch_size: int = 500) -> int:
+        """Завершить активные доставки без обновлений дольше days дней"""
+        cutoff = datetime.now() - timedelta(days=days)
+        completed = 0
+        while True:
+            # Каждая порция - отдельная короткая транзакция
+            with self.engine.begin() as conn:
+                ids = conn.execute(
+                    select(Delivery.id)
+                    .where(Delivery.is_active.is_(True), Delivery.updated_at < cutoff)
+                    .limit(batch_size)
+                ).scalars().all()
+                if not ids:
+                    break
+                # updated_at не трогаем, чтобы архивация считала возраст от последнего обновления
+                conn.execute(
+                    update(Delivery)
+                    .where(Delivery.id.in_(ids))
+                    .values(is_active=False, auto_completed=True, updated_at=Delivery.updated_at)
+                )
+            completed += len(ids)
+            RETENTION_ROWS.labels(action='completed').inc(len(ids))
+        return completed
+    
+    def archive_completed_deliveries(self, days: int, batch_size: int = 500) -> int:
+        """Перенести завершённые доставки старше days дней в deliveries_archive"""
+        cutoff = datetime.now() - timedelta(days=days)
+        archived = 0
+        while True:
+            with self.engine.begin() as conn:
+                rows = conn.execute(
+                    select(Delivery.__table__)
+                    .where(Delivery.is_active.is_(False), Delivery.updated_at < cutoff)
+                    .order_by(Delivery.id)
+                    .limit(batch_size)
+                    # Несколько инстансов не заберут одну порцию дважды (в SQLite игнорируется)
+                    .with_for_update(skip_locked=True)
+                ).mappings().all()
+                if not rows:
+                    break
+                
+                now = datetime.now()
+                conn.execute(insert(DeliveryArchive), [
+                    {'delivery_id': row['id'], 'archived_at': now, **{name: row[name] for name in ARCHIVED_COLUMNS}}
+                    for row in rows
+                ])
+                
+                per_service = {}
+                for row in rows:
+                    per_service[row['service']] = per_service.get(row['service'], 0) + 1
+                for service, count in per_service.items():
+                    result = conn.execute(
+                        update(DeliveryRollup)
+                        .where(DeliveryRollup.service == service)
+                        .values(archived=DeliveryRollup.archived + count)
+                    )
+                    if result.rowcount == 0:
+                        conn.execute(insert(DeliveryRollup).values(service=service, archived=count))
+                
+                conn.execute(delete(Delivery).where(Delivery.id.in_([row['id'] for row in rows])))
+            archived += len(rows)
+            RETENTION_ROWS.labels(action='archived').inc(len(rows))
+        return archived
+    
+    def run_retention(self, stale_days: int, archive_days: int, batch_size: int = 500) -> dict:
+        """Автозавершение зависших и архивация старых доставок (0 дней - шаг выключен)"""
+        result = {'completed': 0, 'archived': 0}
+        try:
+            if stale_days:
+                result['completed'] = self.complete_stale_deliveries(stale_days, batch_size)
+            if archive_days:
+                result['archived'] = self.archive_completed_deliveries(archive_days, batch_size)
+            if result['completed'] or result['archived']:
+                logger.info(f"🗄️ Завершено зависших: {result['completed']}, в архив: {result['archived']}")
+        except Exception as e:
+            logger.error(f"❌ Ошибка ретеншена: {e}")
+        return result
+    
     def get_statistics(self) -> dict:
         """Получить статистику"""
         session = self.Session()
         try:
-            total = session.query(Delivery).count()
-            active = session.query(Delivery).filter_by(is_active=True).count()
+            rows = session.execute(
+                select(
+                    Delivery.service,
+                    func.count(),
+                    func.sum(case((Delivery.is_active.is_(True), 1), else_=0))
+                ).group_by(Delivery.service)
+            ).all()
+            
+            services = {service: count for service, count, _ in rows}
+            active = sum(int(active or 0) for _, _, active in rows)
             
-            services = {}
-            for delivery in session.query(Delivery).all():
-                if delivery.service not in services:
-                    services[delivery.service] = 0
-                services[delivery.service] += 1
+            # Архив учитываем по роллапу, не сканируя deliveries_archive
+            archived = 0
+            for rollup in session.query(DeliveryRollup).all():
+                services[rollup.service] = services.get(rollup.service, 0) + rollup.archived
+                archived += rollup.archived
+            total = sum(services.values())
             
             return {
                 'всего': total,
                 'активных': active,
                 'завершенных': total - active,
+                'в_архиве': archived,
                 'по_сервисам': services
             }
         finally:
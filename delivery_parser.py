@@ -3,22 +3,45 @@
 """
 import json
 import re
-from typing import Dict, Optional, List
+import time
+from typing import Dict, Optional, List, Tuple
 from openai import OpenAI
 import logging
+import metrics
+from token_budget import TokenBudget, estimate_tokens
 
 logger = logging.getLogger(__name__)
 
+LLM_CALLS = metrics.counter('parser_llm_calls_total', 'Вызовы LLM', ['model', 'result'])
+LLM_TOKENS = metrics.counter('parser_llm_tokens_total', 'Токены LLM', ['model', 'kind'])
+LLM_LATENCY = metrics.histogram('parser_llm_seconds', 'Длительность вызова LLM', ['model'])
+PARSE_FAILURES = metrics.counter('parser_failures_total', 'Ошибки разбора ответа LLM', ['reason'])
+PARSE_DEFERRED = metrics.counter('parser_deferred_total', 'Письма, отложенные из-за бюджета токенов')
+
+# Письмо "однозначное", если в нём есть номер отправления и понятный статус.
+# Дефис не входит в номер, чтобы не ловить даты (2025-12-25) и телефоны (8-800-555-35-35);
+# общие слова вроде "ожидает" или "отправлен" встречаются в любых письмах и статусом не считаются
+TRACKING_NUMBER_RE = re.compile(r'\b(?=[A-Z0-9]*\d)[A-Z0-9]{8,}\b')
+STATUS_KEYWORDS = (
+    'доставлен', 'в пути', 'прибыл', 'готов к выдаче', 'передан курьеру',
+    'вручен', 'delivered', 'shipped', 'in transit', 'out for delivery',
+)
+
 
 class DeliveryParser:
     """Парсер для извлечения информации о доставках"""
     
-    def __init__(self, api_key: str):
-        self.client = OpenAI(api_key=api_key)
-        self.model = "gpt-4o-mini"
+    def __init__(self, api_key: str, client=None, model: str = "gpt-4o-mini", cheap_model: str = "",
+                 short_email_tokens: int = 400, max_tokens: int = 500):
+        self.client = client or OpenAI(api_key=api_key)
+        self.model = model
+        self.cheap_model = cheap_model
+        self.short_email_tokens = short_email_tokens
+        self.max_tokens = max_tokens
+        self.deferred = []
     
-    def parse_delivery_email(self, email_data: Dict) -> Optional[Dict]:
-        """Парсить письмо о доставке с помощью GPT"""
+    def build_prompt(self, email_data: Dict) -> Tuple[str, str]:
+        """Собрать промпт, вернуть (текст письма, промпт)"""
         subject = email_data.get('subject', '')
         body = email_data.get('body', '')
         sender = email_data.get('sender', '')
@@ -53,24 +76,63 @@ class DeliveryParser:
     "estimated_delivery": "2025-12-25",
     "recipient_name": "Иван Петров"
 }}"""
-        
+        return full_text, prompt
+    
+    def choose_model(self, email_text: str) -> str:
+        """Короткие и однозначные письма - дешёвой модели, остальные - основной"""
+        if not self.cheap_model:
+            return self.model
+        if estimate_tokens(email_text) <= self.short_email_tokens:
+            return self.cheap_model
+        lowered = email_text.lower()
+        if TRACKING_NUMBER_RE.search(email_text) and any(word in lowered for word in STATUS_KEYWORDS):
+            return self.cheap_model
+        return self.model
+    
+    def parse_delivery_email(self, email_data: Dict, budget: TokenBudget = None) -> Optional[Dict]:
+        """Парсить письмо о доставке с помощью GPT"""
+        email_text, prompt = self.build_prompt(email_data)
+        return self._parse_prompt(prompt, self.choose_model(email_text), budget)
+    
+    def _parse_prompt(self, prompt: str, model: str, budget: TokenBudget = None) -> Optional[Dict]:
+        start = time.perf_counter()
         try:
             response = self.client.chat.completions.create(
-                model=self.model,
-                max_tokens=500,
+                model=model,
+                max_tokens=self.max_tokens,
                 messages=[{"role": "user", "content": prompt}]
             )
-            
+        except Exception as e:
+            LLM_CALLS.labels(model=model, result='error').inc()
+            logger.error(f"❌ Ошибка парсинга: {e}")
+            return None
+        finally:
+            LLM_LATENCY.labels(model=model).observe(time.perf_counter() - start)
+        
+        LLM_CALLS.labels(model=model, result='ok').inc()
+        usage = getattr(response, 'usage', None)
+        prompt_tokens = (usage.prompt_tokens if usage else None) or estimate_tokens(prompt)
+        completion_tokens = usage.completion_tokens if usage else 0
+        LLM_TOKENS.labels(model=model, kind='prompt').inc(prompt_tokens)
+        LLM_TOKENS.labels(model=model, kind='completion').inc(completion_tokens)
+        if budget is not None:
+            budget.record(model, prompt_tokens, completion_tokens)
+        
+        try:
             response_text = response.choices[0].message.content.strip()
             json_match = re.search(r'\{.*\}', response_text, re.DOTALL)
             
-            if json_match:
-                parsed_data = json.loads(json_match.group())
-                if parsed_data.get('is_delivery_email'):
-                    return parsed_data
+            if not json_match:
+                PARSE_FAILURES.labels(reason='no_json').inc()
+                return None
+            
+            parsed_data = json.loads(json_match.group())
+            if parsed_data.get('is_delivery_email'):
+                return parsed_data
             
             return None
         except Exception as e:
+            PARSE_FAILURES.labels(reason='invalid_json').inc()
             logger.error(f"❌ Ошибка парсинга: {e}")
             return None
     
@@ -98,11 +160,29 @@ class DeliveryParser:
         
         return message
     
-    def batch_parse_emails(self, emails: List[Dict]) -> List[Dict]:
-        """Парсить несколько писем"""
+    def batch_parse_emails(self, emails: List[Dict], budget: TokenBudget = None) -> List[Dict]:
+        """
+        Парсить несколько писем.
+        
+        Письма, на которые не хватает бюджета токенов, не парсятся,
+        а складываются в self.deferred до следующей проверки.
+        """
+        budget = budget or TokenBudget()
+        self.deferred = []
         delivery_emails = []
         for email in emails:
-            parsed = self.parse_delivery_email(email)
+            email_text, prompt = self.build_prompt(email)
+            if not budget.can_spend(estimate_tokens(prompt) + self.max_tokens):
+                budget.defer()
+                PARSE_DEFERRED.inc()
+                self.deferred.append(email)
+                continue
+            parsed = self._parse_prompt(prompt, self.choose_model(email_text), budget)
             if parsed:
+                # Источник события для журнала доставок
+                parsed['message_id'] = email.get('id')
+                parsed['received_at'] = email.get('internalDate')
                 delivery_emails.append(parsed)
+        if self.deferred:
+            logger.warning(f"⚠️ Бюджет токенов исчерпан, отложено {len(self.deferred)} писем")
         return delivery_emails
@@ -0,0 +1,59 @@
+"""
+Потоковая выгрузка доставок в NDJSON и CSV
+"""
+import csv
+import io
+import json
+from datetime import datetime
+from typing import Iterable, Iterator, Sequence
+
+FORMATS = {
+    'ndjson': 'application/x-ndjson; charset=utf-8',
+    'csv': 'text/csv; charset=utf-8',
+}
+
+# Строки копятся в буфер и отдаются кусками примерно такого размера
+CHUNK_BYTES = 64 * 1024
+
+
+def _plain(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+def generate_ndjson(columns: Sequence[str], rows: Iterable[tuple]) -> Iterator[str]:
+    """По одному JSON-объекту на строку"""
+    buffer = []
+    size = 0
+    for row in rows:
+        line = json.dumps({name: _plain(value) for name, value in zip(columns, row)}, ensure_ascii=False)
+        buffer.append(line)
+        size += len(line) + 1
+        if size >= CHUNK_BYTES:
+            yield "\n".join(buffer) + "\n"
+            buffer = []
+            size = 0
+    if buffer:
+        yield "\n".join(buffer) + "\n"
+
+
+def generate_csv(columns: Sequence[str], rows: Iterable[tuple]) -> Iterator[str]:
+    """CSV с заголовком"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for row in rows:
+        writer.writerow([_plain(value) for value in row])
+        if buffer.tell() >= CHUNK_BYTES:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+GENERATORS = {
+    'ndjson': generate_ndjson,
+    'csv': generate_csv,
+}
@@ -4,14 +4,20 @@ Gmail API клиент с Service Account
 import base64
 import os
 import json
+import time
 from google.oauth2 import service_account
 from googleapiclient import discovery
 from typing import List, Dict, Optional
 import logging
+import metrics
 
 logger = logging.getLogger(__name__)
 SCOPES = ['https://www.googleapis.com/auth/gmail.readonly']
 
+GMAIL_REQUESTS = metrics.counter('gmail_requests_total', 'Запросы к Gmail API', ['method', 'result'])
+GMAIL_BYTES = metrics.counter('gmail_bytes_total', 'Объём полученных писем (sizeEstimate), байт')
+GMAIL_LATENCY = metrics.histogram('gmail_request_seconds', 'Длительность запроса к Gmail API', ['method'])
+
 
 class GmailClient:
     """Клиент для работы с Gmail API через Service Account"""
@@ -52,23 +58,66 @@ class GmailClient:
                 return []
             
             query = f'newer_than:{hours}h'
-            results = self.service.users().messages().list(userId='me', q=query).execute()
+            results = self._execute('list', self.service.users().messages().list(userId='me', q=query))
             messages = results.get('messages', [])
             
-            emails = []
-            for message in messages:
-                try:
-                    msg = self.service.users().messages().get(userId='me', id=message['id']).execute()
-                    emails.append(msg)
-                except Exception as e:
-                    logger.warning(f"⚠️ Ошибка при получении письма {message['id']}: {e}")
-            
+            emails = self.get_emails_by_ids([message['id'] for message in messages])
             logger.info(f"📧 Получено {len(emails)} писем")
             return emails
         except Exception as e:
             logger.error(f"❌ Ошибка при получении писем: {e}")
             return []
     
+    def get_emails_by_ids(self, message_ids: List[str]) -> List[Dict]:
+        """Получить письма по ID (например, отложенные прошлой проверкой)"""
+        if not self.service:
+            logger.warning("⚠️ Gmail сервис не инициализирован")
+            return []
+        
+        emails = []
+        for message_id in message_ids:
+            try:
+                msg = self._execute('get', self.service.users().messages().get(userId='me', id=message_id))
+                GMAIL_BYTES.inc(msg.get('sizeEstimate', 0))
+                emails.append(self.to_email_data(msg))
+            except Exception as e:
+                logger.warning(f"⚠️ Ошибка при получении письма {message_id}: {e}")
+        return emails
+    
+    def merge_deferred(self, emails: List[Dict], deferred_ids: List[str]) -> List[Dict]:
+        """Поставить отложенные письма в начало списка, догрузив те, что не попали в выборку"""
+        if not deferred_ids:
+            return emails
+        by_id = {email.get('id'): email for email in emails}
+        for email in self.get_emails_by_ids([i for i in deferred_ids if i not in by_id]):
+            by_id[email.get('id')] = email
+        deferred = set(deferred_ids)
+        first = [by_id[i] for i in deferred_ids if i in by_id]
+        return first + [email for email in emails if email.get('id') not in deferred]
+    
+    def to_email_data(self, message: Dict) -> Dict:
+        """Раскодировать письмо Gmail в поля, которые нужны парсеру"""
+        return {
+            'id': message.get('id'),
+            'internalDate': message.get('internalDate'),
+            'subject': self.get_email_subject(message),
+            'sender': self.get_email_sender(message),
+            'body': self.get_email_body(message),
+        }
+    
+    def _execute(self, method: str, request):
+        """Выполнить запрос к Gmail API с учётом метрик"""
+        start = time.perf_counter()
+        try:
+            response = request.execute()
+            GMAIL_REQUESTS.labels(method=method, result='ok').inc()
+            return response
+        except Exception:
+            GMAIL_REQUESTS.labels(method=method, result='error').inc()
+            raise
+        finally:
+            GMAIL_LATENCY.labels(method=method).observe(time.perf_counter() - start)
+    
     def get_email_body(self, message: Dict) -> str:
         """Извлечь текст из письма"""
         try:
@@ -97,3 +146,14 @@ class GmailClient:
         except Exception as e:
             logger.error(f"❌ Ошибка при получении темы: {e}")
             return "No Subject"
+    
+    def get_email_sender(self, message: Dict) -> str:
+        """Получить отправителя письма"""
+        try:
+            for header in message['payload']['headers']:
+                if header['name'].lower() == 'from':
+                    return header['value']
+            return ""
+        except Exception as e:
+            logger.error(f"❌ Ошибка при получении отправителя: {e}")
+            return ""
@@ -8,6 +8,7 @@ from gmail_client import GmailClient
 from delivery_parser import DeliveryParser
 from telegram_bot import DeliveryTelegramBot
 from database import DatabaseManager
+from token_budget import TokenBudget
 
 logging.basicConfig(
     level=logging.INFO,
@@ -23,14 +24,21 @@ logger = logging.getLogger(__name__)
 class DeliveryBot:
     """Главный класс бота"""
     
-    def __init__(self):
-        """Инициализация"""
+    def __init__(self, db: DatabaseManager = None, gmail_client: GmailClient = None,
+                 parser: DeliveryParser = None, telegram_bot: DeliveryTelegramBot = None):
+        """Инициализация (компоненты можно передать готовыми, например в бенчмарке)"""
         Config.validate()
         
-        self.db = DatabaseManager(Config.DATABASE_URL)
-        self.gmail_client = GmailClient(Config.GMAIL_CREDENTIALS, Config.GMAIL_TOKEN)
-        self.parser = DeliveryParser(Config.OPENAI_API_KEY)
-        self.telegram_bot = DeliveryTelegramBot(Config.TELEGRAM_BOT_TOKEN, self.db)
+        self.db = db or DatabaseManager(Config.DATABASE_URL)
+        self.gmail_client = gmail_client or GmailClient(Config.GMAIL_CREDENTIALS, Config.GMAIL_TOKEN)
+        self.parser = parser or DeliveryParser(
+            Config.OPENAI_API_KEY,
+            model=Config.LLM_MODEL,
+            cheap_model=Config.LLM_CHEAP_MODEL,
+            short_email_tokens=Config.LLM_SHORT_EMAIL_TOKENS,
+            max_tokens=Config.LLM_MAX_TOKENS
+        )
+        self.telegram_bot = telegram_bot or DeliveryTelegramBot(Config.TELEGRAM_BOT_TOKEN, self.db)
         
         logger.info("✅ Бот инициализирован")
     
@@ -39,17 +47,39 @@ class DeliveryBot:
         logger.info(f"🔍 Проверяю доставки за {hours} часов...")
         
         try:
+            self.db.run_retention(Config.RETENTION_STALE_DAYS, Config.RETENTION_ARCHIVE_DAYS,
+                                  Config.RETENTION_BATCH_SIZE)
+            
             emails = self.gmail_client.get_emails_since(hours=hours)
+            deferred_ids = self.db.get_deferred_email_ids()
+            # Отложенные письма ждут дольше остальных - парсим их первыми
+            emails = self.gmail_client.merge_deferred(emails, deferred_ids)
             if not emails:
                 logger.info("📭 Писем не найдено")
                 return 0
             
-            deliveries = self.parser.batch_parse_emails(emails)
+            budget = TokenBudget(Config.LLM_RUN_TOKEN_BUDGET, Config.LLM_DAILY_TOKEN_BUDGET,
+                                 self.db.get_tokens_used_today())
+            deliveries = self.parser.batch_parse_emails(emails, budget)
+            self.db.save_llm_usage(budget.summary())
+            if deferred_ids or self.parser.deferred:
+                self.db.set_deferred_email_ids(
+                    [email['id'] for email in self.parser.deferred if email.get('id')],
+                    max_age_days=Config.LLM_DEFERRED_MAX_DAYS,
+                )
             logger.info(f"✅ Найдено {len(deliveries)} доставок")
             
+            # События пишутся в журнал одной пачкой в конце разбора
+            for delivery in deliveries:
+                self.db.record_event(delivery)
+            if self.db.flush_events() is None:
+                logger.error("❌ Доставки не сохранены, уведомления не отправлены")
+                return 0
+            # Заказы, которые не удалось сохранить, не уведомляем
+            deliveries = [d for d in deliveries if str(d.get('order_number')) not in self.db.failed_orders]
+            
             count = 0
             for delivery in deliveries:
-                self.db.add_delivery(delivery)
                 message = self.parser.format_for_telegram(delivery)
                 await self.telegram_bot.send_message(Config.TELEGRAM_CHAT_ID, message)
                 count += 1
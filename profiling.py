@@ -0,0 +1,226 @@
+"""
+Профилирование одной проверки доставок: cProfile, tracemalloc и сэмплер стеков
+"""
+import cProfile
+import json
+import logging
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+MODE_FULL = "full"
+MODE_SAMPLE = "sample"
+
+# Одновременно профилируется только одна проверка
+_session_lock = threading.Lock()
+
+
+def choose_mode(requested: bool, sample_rate: float) -> Optional[str]:
+    """Решить, профилировать ли проверку: по запросу админа или по сэмплингу"""
+    if requested:
+        return MODE_FULL
+    if sample_rate > 0 and random.random() < sample_rate:
+        return MODE_SAMPLE
+    return None
+
+
+# Снимок tracemalloc дорогой: новый берётся, только когда память выросла на 25%
+PEAK_SNAPSHOT_GROWTH = 1.25
+# Аллокации самого профилировщика в отчёт не попадают
+_IGNORED_FILES = (tracemalloc.__file__, cProfile.__file__, __file__)
+
+
+class StackSampler(threading.Thread):
+    """
+    Периодически снимает стек потока и считает одинаковые стеки.
+    
+    С track_memory ещё и держит снимок tracemalloc, сделанный около пика памяти.
+    """
+
+    def __init__(self, thread_id: int, interval: float = 0.005, track_memory: bool = False):
+        super().__init__(name="stack-sampler", daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.track_memory = track_memory
+        self.stacks = Counter()
+        self.peak_snapshot = None
+        self.peak_snapshot_size = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            if self.track_memory:
+                self._check_memory()
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            self.stacks[";".join(reversed(stack))] += 1
+
+    def _check_memory(self):
+        current, _ = tracemalloc.get_traced_memory()
+        if current > self.peak_snapshot_size * PEAK_SNAPSHOT_GROWTH:
+            self.peak_snapshot = tracemalloc.take_snapshot()
+            self.peak_snapshot_size = current
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    def collapsed(self) -> str:
+        """Стеки в collapsed-формате (flamegraph.pl, speedscope)"""
+        return "\n".join(f"{stack} {count}" for stack, count in self.stacks.most_common())
+
+
+class ProfileSession:
+    """
+    Профилирование участка кода.
+
+    full   - cProfile + tracemalloc + сэмплер (для ручного запуска админом)
+    sample - только сэмплер стеков, накладные расходы минимальны
+    """
+
+    def __init__(self, mode: str = MODE_FULL, interval: float = 0.005, top_n: int = 30):
+        self.mode = mode
+        self.interval = interval
+        self.top_n = top_n
+        self.active = False
+        self._sampler = None
+        self._profiler = None
+        self._started_tracemalloc = False
+        self._baseline = None
+        self._start = 0.0
+        self.report = {}
+
+    def __enter__(self):
+        if not _session_lock.acquire(blocking=False):
+            logger.warning("⚠️ Профилирование уже идёт, эта проверка пройдёт без него")
+            return self
+        self.active = True
+        self._start = time.perf_counter()
+
+        if self.mode == MODE_FULL:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(25)
+                self._started_tracemalloc = True
+            tracemalloc.reset_peak()
+            self._baseline = tracemalloc.take_snapshot()
+
+        self._sampler = StackSampler(threading.get_ident(), self.interval, track_memory=self.mode == MODE_FULL)
+        self._sampler.start()
+
+        if self.mode == MODE_FULL:
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if not self.active:
+            return False
+        try:
+            if self._profiler:
+                self._profiler.disable()
+            self._sampler.stop()
+
+            self.report = {
+                'mode': self.mode,
+                'created_at': datetime.now().isoformat(timespec='seconds'),
+                'duration_s': round(time.perf_counter() - self._start, 4),
+                'samples': sum(self._sampler.stacks.values()),
+                'sample_interval_ms': self.interval * 1000,
+                'collapsed_stacks': self._sampler.collapsed(),
+            }
+            if self._profiler:
+                self.report['top_functions'] = self._top_functions()
+            if self.mode == MODE_FULL:
+                self.report.update(self._top_allocations())
+        finally:
+            if self._started_tracemalloc:
+                tracemalloc.stop()
+            _session_lock.release()
+        return False
+
+    def _top_functions(self) -> List[Dict]:
+        stats = pstats.Stats(self._profiler)
+        rows = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)
+        top = []
+        for (filename, line, func), (_, ncalls, tottime, cumtime, _) in rows[:self.top_n]:
+            top.append({
+                'function': f"{func} ({os.path.basename(filename)}:{line})",
+                'calls': ncalls,
+                'tottime_ms': round(tottime * 1000, 3),
+                'cumtime_ms': round(cumtime * 1000, 3),
+            })
+        return top
+
+    def _top_allocations(self) -> Dict:
+        """
+        Что выделено к пику памяти относительно начала проверки.
+        
+        Снимок в конце показал бы только то, что пережило проверку,
+        поэтому берётся снимок сэмплера, сделанный около пика.
+        """
+        current, peak = tracemalloc.get_traced_memory()
+        snapshot, snapshot_size = self._sampler.peak_snapshot, self._sampler.peak_snapshot_size
+        if snapshot is None:
+            snapshot, snapshot_size = tracemalloc.take_snapshot(), current
+        # Фильтруем уже сгруппированные строки: filter_traces по всему снимку на пике в разы дольше
+        stats = [
+            stat for stat in snapshot.compare_to(self._baseline, 'lineno')
+            if stat.traceback[0].filename not in _IGNORED_FILES
+            and not stat.traceback[0].filename.startswith("<frozen importlib")
+        ]
+        top = []
+        for stat in sorted(stats, key=lambda stat: stat.size_diff, reverse=True)[:self.top_n]:
+            if stat.size_diff <= 0:
+                break
+            frame = stat.traceback[0]
+            top.append({
+                'location': f"{frame.filename}:{frame.lineno}",
+                'size_kb': round(stat.size_diff / 1024, 1),
+                'count': stat.count_diff,
+            })
+        return {
+            'peak_traced_mb': round(peak / 1024 / 1024, 2),
+            'snapshot_traced_mb': round(snapshot_size / 1024 / 1024, 2),
+            'top_allocations': top,
+        }
+
+    def save(self, directory: str, keep: int = 20) -> str:
+        """Сохранить отчёт (JSON + .collapsed) и вернуть путь к JSON; хранятся только последние keep отчётов"""
+        os.makedirs(directory, exist_ok=True)
+        base = os.path.join(directory, f"check-{datetime.now():%Y%m%d-%H%M%S-%f}-{self.mode}")
+        with open(f"{base}.collapsed", 'w', encoding='utf-8') as f:
+            f.write(self.report.get('collapsed_stacks', ''))
+        with open(f"{base}.json", 'w', encoding='utf-8') as f:
+            json.dump(self.report, f, ensure_ascii=False, indent=2)
+        logger.info(f"🔬 Профиль проверки сохранён в {base}.json")
+        prune_reports(directory, keep)
+        return f"{base}.json"
+
+
+def prune_reports(directory: str, keep: int):
+    """Удалить старые отчёты: /tmp на Cloud Run живёт в памяти контейнера"""
+    if keep <= 0:
+        return
+    reports = sorted(name[:-len(".json")] for name in os.listdir(directory)
+                     if name.startswith("check-") and name.endswith(".json"))
+    for name in reports[:-keep]:
+        for ext in (".json", ".collapsed"):
+            try:
+                os.remove(os.path.join(directory, name + ext))
+            except FileNotFoundError:
+                pass
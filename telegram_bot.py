@@ -3,12 +3,21 @@ Telegram бот с командами
 """
 from telegram import Update, BotCommand
 from telegram.ext import Application, CommandHandler, ContextTypes
-from telegram.error import TelegramError
+from telegram.error import TelegramError, RetryAfter, NetworkError, BadRequest
+import asyncio
+import html
 import logging
+import metrics
 from database import DatabaseManager
 
 logger = logging.getLogger(__name__)
 
+TELEGRAM_SENDS = metrics.counter('telegram_sends_total', 'Отправленные сообщения', ['result'])
+TELEGRAM_RETRIES = metrics.counter('telegram_retries_total', 'Повторные попытки отправки', ['reason'])
+TELEGRAM_QUEUE_DEPTH = metrics.gauge('telegram_send_queue_depth', 'Сообщения, ожидающие отправки')
+
+MAX_SEND_ATTEMPTS = 3
+
 
 class DeliveryTelegramBot:
     """Telegram бот"""
@@ -25,6 +34,8 @@ class DeliveryTelegramBot:
             BotCommand("check", "🔍 Проверить доставки"),
             BotCommand("status", "📦 Активные доставки"),
             BotCommand("stats", "📊 Статистика"),
+            BotCommand("find", "🔍 Найти доставку"),
+            BotCommand("history", "🕓 История доставки"),
             BotCommand("mark_done", "✅ Отметить как забранную"),
             BotCommand("delete", "🗑️ Удалить доставку"),
             BotCommand("help", "❓ Справка"),
@@ -41,6 +52,8 @@ class DeliveryTelegramBot:
 /check - Проверить доставки
 /status - Активные доставки
 /stats - Статистика
+/find - Найти доставку
+/history - История доставки
 /mark_done - Отметить как забранную
 /delete - Удалить доставку
 /help - Справка"""
@@ -53,6 +66,8 @@ class DeliveryTelegramBot:
 /check - Проверить доставки прямо сейчас
 /status - Показать активные доставки
 /stats - Статистика по доставкам
+/find &lt;текст&gt; - Найти по номеру, сервису, адресу или получателю (и в архиве)
+/history &lt;номер&gt; - История статусов доставки
 /mark_done &lt;номер&gt; - Отметить как забранную
 /delete &lt;номер&gt; - Удалить доставку"""
         await update.message.reply_text(message, parse_mode='HTML')
@@ -63,13 +78,55 @@ class DeliveryTelegramBot:
     
     async def status_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Команда /status"""
-        deliveries = self.db.get_active_deliveries()
+        deliveries = list(self.db.iter_active_deliveries())
         
         if not deliveries:
             await update.message.reply_text("📭 Нет активных доставок", parse_mode='HTML')
             return
         
-        message = "<b>📦 Активные доставки:</b>\n\n"
+        message = "<b>📦 Активные доставки:</b>\n\n" + self.format_deliveries(deliveries)
+        await update.message.reply_text(message, parse_mode='HTML')
+    
+    async def find_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Команда /find"""
+        if not context.args:
+            await update.message.reply_text("❌ Укажи что искать\nПример: /find 6789 или /find сдэк москва", parse_mode='HTML')
+            return
+        
+        query = ' '.join(context.args)
+        deliveries = self.db.search_deliveries(query)
+        
+        if not deliveries:
+            await update.message.reply_text(f"🔍 По запросу <b>{html.escape(query)}</b> ничего не найдено", parse_mode='HTML')
+            return
+        
+        message = f"<b>🔍 Найдено по запросу «{html.escape(query)}»:</b>\n\n" + self.format_deliveries(deliveries)
+        await update.message.reply_text(message, parse_mode='HTML')
+    
+    async def history_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Команда /history"""
+        if not context.args:
+            await update.message.reply_text("❌ Укажи номер заказа\nПример: /history 123456789", parse_mode='HTML')
+            return
+        
+        order_number = context.args[0]
+        events = self.db.get_delivery_history(order_number)
+        if not events:
+            await update.message.reply_text(f"❌ История <code>{html.escape(order_number)}</code> не найдена", parse_mode='HTML')
+            return
+        
+        message = f"<b>🕓 История <code>{html.escape(order_number)}</code>:</b>\n\n"
+        for event in events:
+            message += f"<b>{event.occurred_at:%d.%m.%Y %H:%M}</b> — {event.status or 'N/A'}\n"
+            if event.address:
+                message += f"   Адрес: {event.address}\n"
+        
+        await update.message.reply_text(message, parse_mode='HTML')
+    
+    @staticmethod
+    def format_deliveries(deliveries) -> str:
+        """Список доставок для сообщения"""
+        message = ""
         for i, delivery in enumerate(deliveries, 1):
             message += f"<b>{i}. {delivery.service}</b>\n"
             message += f"   Номер: <code>{delivery.order_number}</code>\n"
@@ -79,8 +136,7 @@ class DeliveryTelegramBot:
             if delivery.pickup_code:
                 message += f"   Код: <code>{delivery.pickup_code}</code>\n"
             message += "\n"
-        
-        await update.message.reply_text(message, parse_mode='HTML')
+        return message
     
     async def stats_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Команда /stats"""
@@ -90,6 +146,8 @@ class DeliveryTelegramBot:
         message += f"📦 Всего: <b>{stats['всего']}</b>\n"
         message += f"✅ Активных: <b>{stats['активных']}</b>\n"
         message += f"🎉 Завершенных: <b>{stats['завершенных']}</b>\n"
+        if stats['в_архиве']:
+            message += f"🗄️ Из них в архиве: <b>{stats['в_архиве']}</b>\n"
         
         if stats['по_сервисам']:
             message += "\n<b>По сервисам:</b>\n"
@@ -131,6 +189,8 @@ class DeliveryTelegramBot:
         self.application.add_handler(CommandHandler("check", self.check_command))
         self.application.add_handler(CommandHandler("status", self.status_command))
         self.application.add_handler(CommandHandler("stats", self.stats_command))
+        self.application.add_handler(CommandHandler("find", self.find_command))
+        self.application.add_handler(CommandHandler("history", self.history_command))
         self.application.add_handler(CommandHandler("mark_done", self.mark_done_command))
         self.application.add_handler(CommandHandler("delete", self.delete_command))
         
@@ -143,10 +203,31 @@ class DeliveryTelegramBot:
         await self.application.run_polling()
     
     async def send_message(self, chat_id: int, message: str) -> bool:
-        """Отправить сообщение"""
+        """Отправить сообщение (с повтором при flood control и сетевых ошибках)"""
+        TELEGRAM_QUEUE_DEPTH.inc()
         try:
-            await self.application.bot.send_message(chat_id=chat_id, text=message, parse_mode='HTML')
-            return True
+            for attempt in range(1, MAX_SEND_ATTEMPTS + 1):
+                try:
+                    await self.application.bot.send_message(chat_id=chat_id, text=message, parse_mode='HTML')
+                    TELEGRAM_SENDS.labels(result='ok').inc()
+                    return True
+                except RetryAfter as e:
+                    if attempt == MAX_SEND_ATTEMPTS:
+                        raise
+                    TELEGRAM_RETRIES.labels(reason='retry_after').inc()
+                    delay = e.retry_after
+                    await asyncio.sleep(delay.total_seconds() if hasattr(delay, 'total_seconds') else delay)
+                except BadRequest:
+                    # Постоянная ошибка (например, битый HTML) - повтор не поможет
+                    raise
+                except NetworkError:
+                    if attempt == MAX_SEND_ATTEMPTS:
+                        raise
+                    TELEGRAM_RETRIES.labels(reason='network').inc()
+                    await asyncio.sleep(attempt)
         except TelegramError as e:
+            TELEGRAM_SENDS.labels(result='error').inc()
             logger.error(f"❌ Ошибка Telegram: {e}")
             return False
+        finally:
+            TELEGRAM_QUEUE_DEPTH.dec()
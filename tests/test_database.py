@@ -0,0 +1,120 @@
+"""
+Журнал событий доставок: flush_events и ретеншен
+"""
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import update
+
+from database import DatabaseManager, Delivery
+
+
+def received(days_ago: float) -> str:
+    """internalDate письма, полученного days_ago дней назад"""
+    return str(int((datetime.now() - timedelta(days=days_ago)).timestamp() * 1000))
+
+
+def make_old(db, order_number: str, days: int):
+    with db.engine.begin() as conn:
+        conn.execute(
+            update(Delivery)
+            .where(Delivery.order_number == order_number)
+            .values(updated_at=datetime.now() - timedelta(days=days))
+        )
+
+
+def get_delivery(db, order_number: str) -> Delivery:
+    session = db.Session()
+    try:
+        return session.query(Delivery).filter_by(order_number=order_number).one()
+    finally:
+        session.close()
+
+
+@pytest.fixture
+def db(tmp_path):
+    manager = DatabaseManager(f"sqlite:///{tmp_path / 'deliveries.db'}")
+    yield manager
+    manager.engine.dispose()
+
+
+def test_same_email_is_recorded_once(db):
+    email = {'order_number': 'A1', 'delivery_service': 'СДЭК', 'delivery_status': 'В пути', 'message_id': 'm1'}
+    db.record_event(email)
+    db.record_event(email)
+    assert db.flush_events() == 1
+
+    db.record_event(email)
+    assert db.flush_events() == 0
+    assert len(db.get_delivery_history('A1')) == 1
+
+
+def test_older_email_does_not_overwrite_state(db):
+    db.record_event({'order_number': 'A1', 'delivery_status': 'Доставлен', 'message_id': 'new', 'received_at': received(1)})
+    db.flush_events()
+    db.record_event({'order_number': 'A1', 'delivery_status': 'В пути', 'message_id': 'old', 'received_at': received(3)})
+    assert db.flush_events() == 1
+
+    assert get_delivery(db, 'A1').status == 'Доставлен'
+    assert [e.status for e in db.get_delivery_history('A1')] == ['В пути', 'Доставлен']
+
+
+def test_email_for_archived_order_restores_it(db):
+    db.add_delivery({'order_number': 'A1', 'service': 'СДЭК', 'status': 'В пути',
+                     'message_id': 'm1', 'received_at': received(200)})
+    make_old(db, 'A1', 200)
+    assert db.complete_stale_deliveries(30) == 1
+    make_old(db, 'A1', 200)
+    assert db.archive_completed_deliveries(90) == 1
+    assert db.get_statistics()['в_архиве'] == 1
+
+    assert db.add_delivery({'order_number': 'A1', 'status': 'Прибыл в пункт выдачи', 'message_id': 'm2'})
+
+    delivery = get_delivery(db, 'A1')
+    assert (delivery.service, delivery.status, delivery.is_active) == ('СДЭК', 'Прибыл в пункт выдачи', True)
+    stats = db.get_statistics()
+    assert (stats['всего'], stats['в_архиве'], stats['по_сервисам']) == (1, 0, {'СДЭК': 1})
+
+
+def test_manually_closed_delivery_stays_closed(db):
+    db.add_delivery({'order_number': 'A1', 'status': 'В пути', 'message_id': 'm1', 'received_at': received(2)})
+    db.mark_as_inactive('A1')
+    db.add_delivery({'order_number': 'A1', 'status': 'Вручен', 'message_id': 'm2'})
+    assert get_delivery(db, 'A1').is_active is False
+
+
+def test_failed_order_does_not_sink_batch(db, monkeypatch):
+    write_events = db._write_events
+
+    def failing(session, events):
+        if any(e['order_number'] == 'BAD' for e in events):
+            raise ValueError("value too long")
+        return write_events(session, events)
+
+    monkeypatch.setattr(db, '_write_events', failing)
+    for order_number in ('A1', 'BAD', 'B2'):
+        db.record_event({'order_number': order_number, 'message_id': f'm-{order_number}'})
+
+    assert db.flush_events() == 2
+    assert db.failed_orders == {'BAD'}
+    assert sorted(row.order_number for row in db.iter_active_deliveries()) == ['A1', 'B2']
+
+
+def test_events_return_to_buffer_when_database_fails(db, monkeypatch):
+    session_factory = db.Session
+
+    def database_down(*args, **kwargs):
+        raise RuntimeError("db down")
+
+    def broken_session():
+        session = session_factory()
+        monkeypatch.setattr(session, 'execute', database_down)
+        return session
+
+    db.record_event({'order_number': 'A1', 'message_id': 'm1'})
+    monkeypatch.setattr(db, 'Session', broken_session)
+    assert db.flush_events() is None
+
+    monkeypatch.setattr(db, 'Session', session_factory)
+    assert db.flush_events() == 1
+    assert get_delivery(db, 'A1').is_active is True
@@ -0,0 +1,68 @@
+"""
+Учёт и ограничение токенов LLM за проверку и за сутки
+"""
+import math
+from typing import Dict
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Оценить число токенов без токенизатора.
+
+    Для смеси кириллицы и латиницы у моделей OpenAI выходит ~3 символа на токен,
+    оценка слегка завышена, чтобы бюджет не перерасходовался.
+    """
+    if not text:
+        return 0
+    return math.ceil(len(text) / 3)
+
+
+class TokenBudget:
+    """Бюджет токенов на одну проверку (0 - без ограничения)"""
+
+    def __init__(self, run_limit: int = 0, daily_limit: int = 0, used_today: int = 0):
+        self.run_limit = run_limit
+        self.daily_limit = daily_limit
+        self.used_today = used_today
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.deferred = 0
+        self.models = {}
+
+    @property
+    def used(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+    def remaining(self) -> float:
+        """Сколько токенов ещё можно потратить в этой проверке"""
+        limits = []
+        if self.run_limit:
+            limits.append(self.run_limit - self.used)
+        if self.daily_limit:
+            limits.append(self.daily_limit - self.used_today - self.used)
+        return max(0, min(limits)) if limits else math.inf
+
+    def can_spend(self, tokens: int) -> bool:
+        return tokens <= self.remaining()
+
+    def record(self, model: str, prompt_tokens: int, completion_tokens: int):
+        self.calls += 1
+        self.prompt_tokens += prompt_tokens
+        self.completion_tokens += completion_tokens
+        stats = self.models.setdefault(model, {'calls': 0, 'prompt_tokens': 0, 'completion_tokens': 0})
+        stats['calls'] += 1
+        stats['prompt_tokens'] += prompt_tokens
+        stats['completion_tokens'] += completion_tokens
+
+    def defer(self):
+        self.deferred += 1
+
+    def summary(self) -> Dict:
+        return {
+            'calls': self.calls,
+            'prompt_tokens': self.prompt_tokens,
+            'completion_tokens': self.completion_tokens,
+            'deferred': self.deferred,
+            'models': self.models,
+        }